@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark of renames through open folders, against renames by full path,
+on a deep synthetic tree.
+
+    python3 bench/folders.py [depth] [folders] [files]
+
+Files are renamed in place, in each leaf folder of the tree, as a plain
+rename by the system, then as logged renames of `action.Renamer`.
+The temporary tree is made where TMPDIR tells, to run it on a network
+file system.
+
+Results are written into bench_output.txt, at the root of the project.
+"""
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import action
+from utils import FolderFds, rename_noreplace
+
+
+OUTPUT = ROOT / "bench_output.txt"
+
+# levels of folders down to the leaves, leaf folders, and files in each
+DEPTH = 12
+FOLDERS = 100
+FILES = 200
+
+# runs of each way, on a new tree each time, the fastest one being kept
+RUNS = 5
+
+
+def make_tree(root: str, depth: int, folders: int, files: int) -> [str]:
+    """
+    Create the files of the tree, and return their paths.
+    """
+    paths = []
+    for folder in range(folders):
+        parts = ["level{}".format(level) for level in range(depth - 1)]
+        path = os.path.join(root, *parts, "leaf{}".format(folder))
+        os.makedirs(path)
+        for index in range(files):
+            name = os.path.join(path, "file{}.txt".format(index))
+            open(name, "w").close()
+            paths.append(name)
+    return paths
+
+
+def renamed(path: str) -> str:
+    (folder, name) = os.path.split(path)
+    return os.path.join(folder, name.upper())
+
+
+def by_path(root: str, paths: [str]):
+    for path in paths:
+        rename_noreplace(path, renamed(path))
+
+
+def by_folder(root: str, paths: [str]):
+    folders = FolderFds()
+    for path in paths:
+        (folder, name) = os.path.split(path)
+        fd = folders.open(folder)
+        rename_noreplace(name, name.upper(), src_dir_fd=fd, dst_dir_fd=fd)
+    folders.clear()
+
+
+def with_renamer(folders: bool):
+    def rename(root: str, paths: [str]):
+        log = action.Log(Path(root, "action_log"))
+        log.open_write()
+        renamer = action.Renamer(log)
+        if not folders:
+            renamer._folders = None
+        mode = action.Flag.from_(user_given_entry=False,
+                                 rule_is_manual=False,
+                                 simulation=False)
+        for path in paths:
+            if not renamer.rename(Path(path), Path(renamed(path)), "r", mode):
+                raise RuntimeError("{} not renamed".format(path))
+        renamer.close()
+        log.close_write()
+    return rename
+
+
+def measure(rename: callable, depth: int, folders: int, files: int) -> float:
+    """
+    Time (in seconds) of a rename, on a new tree.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_tree(root, depth, folders, files)
+        start = time.perf_counter()
+        rename(root, paths)
+        return (time.perf_counter() - start) / len(paths)
+
+
+def bench(depth: int, folders: int, files: int, output):
+    output("tree {} levels deep, {} leaf folders of {} files".format(
+        depth, folders, files))
+    if not FolderFds.supported:
+        output("renames relative to folders are not supported here")
+        return
+
+    for (label, by_paths, by_folders) in (
+            ("rename", by_path, by_folder),
+            ("Renamer.rename", with_renamer(False), with_renamer(True))):
+        # runs alternate, not to give one way a quieter time
+        (paths, fds) = (float("inf"), float("inf"))
+        for _ in range(RUNS):
+            paths = min(paths, measure(by_paths, depth, folders, files))
+            fds = min(fds, measure(by_folders, depth, folders, files))
+        output("{:<15} {:6.1f} us by path, {:6.1f} us by folder ({:+.0%})"
+               .format(label, paths * 1e6, fds * 1e6, fds / paths - 1))
+
+
+def main():
+    (depth, folders, files) = ([int(arg) for arg in sys.argv[1:4]]
+                               or (DEPTH, FOLDERS, FILES))
+    with open(str(OUTPUT), "w") as results:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        bench(depth, folders, files, output)
+
+
+if __name__ == "__main__":
+    main()
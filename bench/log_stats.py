@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark of `fir log --stats` on a large log: the log loaded as columns
+then counted by group, against a LogLine read per action and counted in
+Python.
+
+    python3 bench/log_stats.py [actions]
+
+Each way runs in its own process, for its peak memory. The log is made in
+a temporary folder, where TMPDIR tells (about 60 bytes per action).
+
+Results are written into bench_output.txt, at the root of the project.
+"""
+
+import sys
+import time
+import random
+import datetime
+import resource
+import tempfile
+import collections
+import multiprocessing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import action
+import table
+
+
+OUTPUT = ROOT / "bench_output.txt"
+
+# actions of the log, over a month, by 20 rules
+COUNT = 10000000
+RULES = 20
+DAYS = 30
+
+
+def make_log(path: Path, count: int):
+    """
+    Write actions into the log, as Renamer does, without the renames.
+    """
+    rng = random.Random(42)
+    rules = ["{:012x}".format(rng.getrandbits(48)) for _ in range(RULES)]
+    start = datetime.datetime(2026, 9, 1)
+    mode = int(action.Flag.from_(user_given_entry=False,
+                                 rule_is_manual=False,
+                                 simulation=False))
+    log = action.Log(path)
+    log.open_write()
+    (write, write_paths) = (log.write, log.write_paths)
+    for index in range(count):
+        when = start + datetime.timedelta(
+            seconds=index * DAYS * 24 * 3600 // count,
+            microseconds=rng.randrange(1000000))
+        write(action.MAGIC_NUMBER)
+        write(when.isoformat())
+        write(rules[index % RULES])
+        write(mode)
+        folder = "archive/p{}/b{}".format(index % 13, index // 400)
+        write_paths("/data",
+                    "{}/f{}.txt".format(folder, index),
+                    "{}/F{}.TXT".format(folder, index))
+        # a few failures
+        write(rng.random() > 0.01)
+    log.close_write()
+
+
+def by_columns(path: Path) -> dict:
+    log = action.Log(path)
+    log.open_read()
+    start = time.perf_counter()
+    log_table = table.LogTable.load(log)
+    log.close_read()
+    times = {"load": time.perf_counter() - start}
+    for group_by in table.GROUP_BY:
+        start = time.perf_counter()
+        rows = log_table.stats(group_by)
+        times[group_by] = time.perf_counter() - start
+    return {"actions": len(log_table), "times": times,
+            "failed": sum(row.failed for row in rows)}
+
+
+def by_lines(path: Path) -> dict:
+    log = action.Log(path)
+    log.open_read()
+    start = time.perf_counter()
+    counts = collections.Counter()
+    for line in log.read_iter():
+        counts[(line.rule_id, line.when[:10], line.success)] += 1
+    log.close_read()
+    return {"actions": sum(counts.values()),
+            "times": {"load": time.perf_counter() - start},
+            "failed": sum(count for ((_, _, success), count) in counts.items()
+                          if success is False)}
+
+
+def run(way: callable, path: Path, queue):
+    result = way(path)
+    # in kB
+    result["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(result)
+
+
+def bench(count: int, output) -> bool:
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder, "action_log")
+        start = time.perf_counter()
+        make_log(path, count)
+        output("{} actions, {:.0f} MB, written in {:.0f} s".format(
+            count, path.stat().st_size / 2**20, time.perf_counter() - start))
+
+        results = {}
+        for way in (by_columns, by_lines):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run,
+                                              args=(way, path, queue))
+            process.start()
+            results[way] = result = queue.get()
+            process.join()
+            output("{:<10} {}, peak RSS {} MB".format(
+                way.__name__,
+                ", ".join("{} {:.1f} s".format(step, seconds)
+                          for (step, seconds) in result["times"].items()),
+                result["rss"] // 1024))
+
+    columns, lines = results[by_columns], results[by_lines]
+    if (columns["actions"], columns["failed"]) != (lines["actions"],
+                                                   lines["failed"]):
+        output("different counts: {} against {}".format(columns, lines))
+        return False
+    return columns["actions"] == count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    with open(str(OUTPUT), "w") as results:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        ok = bench(count, output)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Soak benchmark of the action log: write millions of actions in a single
+session, and check that the memory of the process stays flat.
+
+    python3 bench/soak.py [count]
+
+Results are written into bench_output.txt, at the root of the project.
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import action
+
+
+OUTPUT = ROOT / "bench_output.txt"
+
+# actions written by default
+COUNT = 2000000
+
+# growth (in kB) of the peak RSS allowed once a tenth of the actions are
+# written: what buffers may still take, far below what keeping each path
+# would
+GROWTH_LIMIT = 2048
+
+
+def peak_rss() -> int:
+    """
+    Peak resident memory of the process, in kB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def soak(folder: Path, count: int, output):
+    log = action.Log(folder / "action_log")
+    log.open_write()
+    renamer = action.Renamer(log)
+    # simulated: only the log is written
+    mode = action.Flag.from_(user_given_entry=False,
+                             rule_is_manual=False,
+                             simulation=True)
+
+    start = time.perf_counter()
+    checkpoints = {count // 10, count // 2}
+    baseline = None
+    for index in range(count):
+        if index in checkpoints:
+            rss = peak_rss()
+            baseline = baseline or rss
+            output("{:>10} actions: peak RSS {} kB".format(index, rss))
+        # a folder every few files, like a large tree
+        parent = "dir/sub{}/{}".format(index // 10000, index // 10)
+        renamer.rename(Path("{}/file{}.txt".format(parent, index)),
+                       Path("{}/FILE{}.TXT".format(parent, index)),
+                       "abcdef012345",
+                       mode)
+    log.close_write()
+    elapsed = time.perf_counter() - start
+
+    rss = peak_rss()
+    size = (folder / "action_log").stat().st_size
+    output("{:>10} actions: peak RSS {} kB".format(count, rss))
+    output("{:.0f} actions/s, {:.1f} bytes/action".format(count / elapsed,
+                                                          size / count))
+
+    # every action is read back
+    log.open_read()
+    read = sum(1 for _ in log.read_iter())
+    log.close_read()
+    output("{} actions read back".format(read))
+
+    assert read == count, "{} actions written, {} read".format(count, read)
+    assert rss - baseline <= GROWTH_LIMIT, \
+        "peak RSS grew by {} kB".format(rss - baseline)
+    output("OK: peak RSS grew by {} kB".format(rss - baseline))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    with open(str(OUTPUT), "w") as results, \
+            tempfile.TemporaryDirectory() as folder:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        soak(Path(folder), count, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Stress test of processes writing at once into the same action log and rule
+database: every record written must be read back intact.
+
+    python3 bench/stress.py [writers] [actions]
+
+Results are written into test_output.txt, at the root of the project.
+"""
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import action
+import book
+import well
+
+
+OUTPUT = ROOT / "test_output.txt"
+
+# processes writing at once, and actions written by each one
+WRITERS = 8
+ACTIONS = 20000
+
+# rules appended by each writer, while others save the whole database
+RULES = 20
+SAVES = 20
+
+
+def paths(writer: int, index: int) -> (str, str):
+    return ("w{}/sub{}/file{}.txt".format(writer, index % 7, index),
+            "w{}/FILE{}.TXT".format(writer, index))
+
+
+def write_log(log_path: Path, writer: int, count: int):
+    log = action.Log(log_path)
+    log.open_write()
+    renamer = action.Renamer(log)
+    mode = action.Flag.from_(user_given_entry=False,
+                             rule_is_manual=False,
+                             simulation=True)
+    for index in range(count):
+        (source, dest) = paths(writer, index)
+        renamer.rename(Path(source), Path(dest), "w{}".format(writer), mode)
+    log.close_write()
+
+
+def check_log(log_path: Path, writers: int, count: int, killed: int,
+              output) -> bool:
+    """
+    Check that each writer wrote all its actions once and in order, but the
+    killed one, which may stop anywhere.
+    """
+    done = {"w{}".format(writer): 0 for writer in range(writers + 1)}
+    errors = 0
+    log = action.Log(log_path)
+    log.open_read()
+    for line in log.read_iter():
+        writer = int(line.rule_id[1:])
+        index = done[line.rule_id]
+        (source, dest) = paths(writer, index)
+        if (line.source, line.dest, line.success) != (source, dest, True):
+            errors += 1
+            output("invalid action of {}: {} --> {} ({})".format(
+                line.rule_id, line.source, line.dest, line.success))
+        done[line.rule_id] += 1
+    log.close_read()
+
+    for writer in range(writers + 1):
+        written = done["w{}".format(writer)]
+        output("writer {}: {} action(s){}".format(
+            writer, written, " (killed)" if writer == killed else ""))
+        if writer != killed and written != count:
+            errors += 1
+    output("{} segment(s)".format(len(log.segments())))
+    return errors == 0
+
+
+def append_rules(db_path: Path, writer: int, count: int):
+    for index in range(count):
+        rule = book.Rules().add(r"w{}_{}\.txt$".format(writer, index),
+                                "{0}", name="w{}_{}".format(writer, index))
+        well.append_rule(db_path, rule)
+
+
+def save_rules(db_path: Path, count: int):
+    for _ in range(count):
+        well.save_rules(db_path, well.load_rules(db_path))
+
+
+def check_rules(db_path: Path, writers: int, count: int, output) -> bool:
+    rules = well.load_rules(db_path)
+    names = {rule.name for rule in rules}
+    missing = ["w{}_{}".format(writer, index)
+               for writer in range(writers)
+               for index in range(count)
+               if "w{}_{}".format(writer, index) not in names]
+    output("{} rule(s), {} missing".format(len(rules), len(missing)))
+    return not missing
+
+
+def run(processes: [multiprocessing.Process]):
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def stress(folder: Path, writers: int, count: int, output) -> bool:
+    log_path = folder / "action_log"
+    start = time.perf_counter()
+    processes = [multiprocessing.Process(target=write_log,
+                                         args=(log_path, writer, count))
+                 for writer in range(writers + 1)]
+    # the last writer is killed while it writes
+    killed = processes[-1]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)
+    os.kill(killed.pid, signal.SIGKILL)
+    for process in processes:
+        process.join()
+    output("log: {} writers, {:.1f} s".format(len(processes),
+                                              time.perf_counter() - start))
+    log_ok = check_log(log_path, writers, count, writers, output)
+
+    # rules appended and compacted by some, while others save them whole
+    db_path = folder / "rules.db"
+    well.COMPACT_MIN_SIZE = 0
+    start = time.perf_counter()
+    run([multiprocessing.Process(target=append_rules,
+                                 args=(db_path, writer, RULES))
+         for writer in range(writers)]
+        + [multiprocessing.Process(target=save_rules, args=(db_path, SAVES))
+           for _ in range(writers // 2)])
+    output("rules: {} writers, {:.1f} s".format(writers + writers // 2,
+                                                time.perf_counter() - start))
+    rules_ok = check_rules(db_path, writers, RULES, output)
+
+    return log_ok and rules_ok
+
+
+def main():
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else WRITERS
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else ACTIONS
+    with open(str(OUTPUT), "w") as results, \
+            tempfile.TemporaryDirectory() as folder:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        ok = stress(Path(folder), writers, count, output)
+        output("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the index of rules by suffix, on a corpus of files with mixed
+extensions: each file is only tried with the rules of its suffix and the
+catch-all ones, against all rules without the index.
+
+    python3 bench/suffixes.py [files]
+
+Results are written into bench_output.txt, at the root of the project.
+"""
+
+import sys
+import time
+import random
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import book
+
+
+OUTPUT = ROOT / "bench_output.txt"
+
+# files of the corpus
+COUNT = 100000
+
+EXTENSIONS = ("mkv", "avi", "mp4", "srt", "jpg", "png", "txt", "nfo", "pdf",
+              "flac", "MKV", "JPG", ".mkv")
+
+# rules per extension, and catch-all rules
+RULES_PER_EXTENSION = 4
+CATCH_ALL = 1
+
+
+def corpus(count: int) -> [str]:
+    rng = random.Random(42)
+    paths = []
+    for index in range(count):
+        extension = rng.choice(EXTENSIONS)
+        # names like '.mkv' have no stem
+        name = (extension
+                if extension.startswith(".")
+                else "Show.S{:02}E{:02}.{}".format(index % 9, index % 24,
+                                                    extension))
+        paths.append("archive/{}/{}".format(index % 97, name))
+    return paths
+
+
+def make_rules() -> book.Rules:
+    rules = book.Rules()
+    for extension in EXTENSIONS[:10]:
+        for index in range(RULES_PER_EXTENSION):
+            rules.add(r"^(\w+)\.S(\d+)E(\d+)x?{}\.{}$".format(
+                "x" * index, extension), "{1} {2}x{3}")
+    for index in range(CATCH_ALL):
+        rules.add(r"^\w+\.S(\d+)E0{}\.".format(index), "{1}")
+    return rules
+
+
+def all_rules(rules: book.Rules, path: str) -> [str]:
+    # what was done before the index: every rule tried on every file
+    return [rule.guid for rule in rules.ordered() if rule.match(path)]
+
+
+def indexed(rules: book.Rules, path: str) -> [str]:
+    return [rule.guid for (rule, _, _) in rules.find_applying(path)]
+
+
+def bench(count: int, output) -> bool:
+    paths = corpus(count)
+    rules = make_rules()
+    output("{} files, {} rules, {} extensions".format(
+        len(paths), len(rules), len(EXTENSIONS)))
+
+    results = {}
+    for find in (all_rules, indexed):
+        start = time.perf_counter()
+        results[find] = [find(rules, path) for path in paths]
+        elapsed = time.perf_counter() - start
+        output("{:<10} {:.2f} s, {:.0f} files/s, {} matches".format(
+            find.__name__, elapsed, count / elapsed,
+            sum(map(len, results[find]))))
+
+    if results[all_rules] != results[indexed]:
+        output("different matches with the index")
+        return False
+    return True
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    with open(str(OUTPUT), "w") as results:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        ok = bench(count, output)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of rename templates: formats per second of the template
+compiled once, against `string.Formatter` parsing it on each format.
+
+    python3 bench/template.py [count]
+
+Results are written into bench_output.txt, at the root of the project.
+"""
+
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import book
+
+
+OUTPUT = ROOT / "bench_output.txt"
+
+# formats of each template
+COUNT = 200000
+
+# (identifier, rename template, name matched)
+CASES = (
+    (r"(\w+)\.txt$", "{1}.TXT", "notes.txt"),
+    (r"(?P<n>\w+)-(\d+)\.(\w+)$", "{n!u}-{2:>04}.{3!c}", "show-7.mkv"),
+    (r"(\w+) S(\d+)E(\d+) (.*)\.(\w+)$", "{1}/Season {2:0>2}/{1} - {2}x{3}"
+     " - {4!l}.{5}", "Show S1E05 The Title.mkv"),
+    (r"(?P<y>\d{4})(?P<m>\d\d)(?P<d>\d\d)_(\w+)\.jpg$",
+     "{y}/{m}/{y}-{m}-{d} {4!c}.jpg", "20240131_holidays.jpg"),
+)
+
+
+def measure(format_, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        format_()
+    return count / (time.perf_counter() - start)
+
+
+def bench(count: int, output) -> bool:
+    ok = True
+    output("{:<40} {:>12} {:>12} {:>8}".format(
+        "template", "formatter/s", "compiled/s", "speedup"))
+    for (identifier, rename, name) in CASES:
+        match = re.match(identifier, name)
+        args = (None,) + match.groups()
+        kwargs = match.groupdict()
+        template = book.Template(rename)
+
+        expected = book.file_formatter.format(rename, *args, **kwargs)
+        if template.format(args, kwargs) != expected:
+            output("different result for {}".format(rename))
+            ok = False
+
+        formatter = measure(
+            lambda: book.file_formatter.format(rename, *args, **kwargs),
+            count)
+        compiled = measure(lambda: template.format(args, kwargs), count)
+        output("{:<40} {:>12.0f} {:>12.0f} {:>7.1f}x".format(
+            rename[:40], formatter, compiled, compiled / formatter))
+    return ok
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    with open(str(OUTPUT), "w") as results:
+        def output(text):
+            print(text)
+            results.write(text + "\n")
+            results.flush()
+        ok = bench(count, output)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,44 @@
 
+import os
+import errno
 from pathlib import Path
 import datetime
 import pickle
+import random
+import heapq
 
 import logger
+from utils import lock_file, replace_file, rename_noreplace
+from utils import RateLimiter, FolderFds
 
 
 MAGIC_NUMBER = 0x1100FE
 
+# number of fields of an action before its result
+LOG_LINE_PATHS_END = 7
+
+# paths of actions are written as (source folder id, name, dest folder id,
+# name), with the folders defined the first time they are used by
+# ("folder", id, folder), and what folders are relative to by
+# ("session", cwd)
+LOG_SESSION = "session"
+LOG_FOLDER = "folder"
+
+# folders defined in a session before another one is started, forgetting
+# them: memory of writers and readers does not grow with the tree
+SESSION_FOLDERS = 4096
+
+# unlike later ones, it does not add a frame header to each field
+LOG_PROTOCOL = 3
+PLAN_MAGIC_NUMBER = 0x1100FD
+
 
 class ActionFlag(int):
     # Flag part
     RENAMED         = 0b0001
     MANUAL_RULE     = 0b0010
     USER_ENTRY      = 0b0100
+    FOLDER          = 0b1000
 
     @property
     def was_renamed(self) -> bool:
@@ -39,11 +64,18 @@ class ActionFlag(int):
     def entry_was_found(self) -> bool:
         return not (self & self.USER_ENTRY)
 
+    @property
+    def is_folder(self) -> bool:
+        return bool(self & self.FOLDER)
+
     @staticmethod
     def from_(user_given_entry: bool,
               rule_is_manual: bool,
-              simulation:bool):
+              simulation:bool,
+              folder: bool=False):
         res = 0
+        if folder:
+            res += ActionFlag.FOLDER
         if not simulation:
             res += ActionFlag.RENAMED
         if rule_is_manual:
@@ -71,6 +103,8 @@ class LogLine:
          *self._result) = data
 
         self.mode = ActionFlag(self.mode)
+        # where the action starts in its segment, if read from an offset
+        self.offset = None
 
     @property
     def success(self) -> bool:
@@ -82,22 +116,97 @@ class LogLine:
         return datetime.datetime.strptime(self.when, 'auto')
 
 
+class SummaryLine:
+    """
+    Summary of simulated renames of a whole run, from the action log.
+    """
+
+    def __init__(self, data: dict):
+        self.when = data["when"]
+        self.mode = ActionFlag(data["mode"])
+        # number of simulated renames per rule id
+        self.counts = data["counts"]
+        # sample of (rule id, source, dest)
+        self.examples = data["examples"]
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
 class Log:
     """
     Log of all actions taken (even simulated).
+
+    Several processes can log at once: each one writes into its own segment,
+    the log file itself or `<log>.1`, `<log>.2`..., locked while it is open.
+    Segments are merged when the log is read.
     """
 
     def __init__(self, path: Path):
         self.path = path
+        # segment written into
+        self.write_path = None
         self._file = None
         self._picklog = None
+        self._inputs = []
+        # folder ids of the session written
+        self._cwd = None
+        self._folders = {}
 
-    def open_write(self):
+    def segments(self) -> [Path]:
         """
-        Open the log to write into it.
+        Existing files of the log, the log itself first.
         """
-        self._file = open(str(self.path), "a+b")
-        self._picklog = pickle.Pickler(self._file)
+        numbered = []
+        prefix = self.path.name + "."
+        if self.path.parent.is_dir():
+            for sibling in self.path.parent.iterdir():
+                number = sibling.name[len(prefix):]
+                if sibling.name.startswith(prefix) and number.isdigit():
+                    numbered.append((int(number), sibling))
+        paths = [path for (_, path) in sorted(numbered)]
+        if self.path.exists():
+            paths.insert(0, self.path)
+        return paths
+
+    def _candidates(self):
+        yield self.path
+        index = 1
+        while True:
+            yield self.path.with_name("{}.{}".format(self.path.name, index))
+            index += 1
+
+    def open_write(self, segment: Path=None):
+        """
+        Open the log to write into it, in the given segment or in the first
+        one not used by another process, nor left by a run to resume.
+        Return False if the given segment is used.
+        """
+        for path in ([segment] if segment else self._candidates()):
+            # what is written after a run stopped would be taken for its
+            # actions when resuming it
+            if not segment and Cursor(path).path.exists():
+                continue
+            output = open(str(path), "a+b")
+            if lock_file(output):
+                break
+            output.close()
+            if segment:
+                return False
+
+        self.write_path = path
+        self._file = output
+        self._picklog = pickle.Pickler(self._file, LOG_PROTOCOL)
+        # without memo, the pickler keeps no reference on what it wrote, and
+        # no field refers to another one: memory stays the same however long
+        # the session is, and sessions appended to the log stay readable
+        # (logged data is never self-referencing)
+        self._picklog.fast = True
+        # a new session is started on the first paths written, as what is
+        # written before may be cut when resuming
+        self._cwd = None
+        return True
 
     def close_write(self):
         """
@@ -105,6 +214,7 @@ class Log:
         """
         self._picklog = None
         self._file.flush()
+        # closing releases the lock
         self._file.close()
         self._file = None
 
@@ -118,6 +228,29 @@ class Log:
         """
         self._picklog.dump(what)
 
+    def write_paths(self, cwd: str, source: str, dest: str):
+        """
+        Write the paths of an action, relative to `cwd` unless absolute.
+        Folders are only written once per session: an action takes little
+        more than the names of its files. A session defines at most
+        SESSION_FOLDERS folders.
+        """
+        if cwd != self._cwd or len(self._folders) >= SESSION_FOLDERS:
+            self._picklog.dump((LOG_SESSION, cwd))
+            self._cwd = cwd
+            self._folders = {}
+
+        paths = []
+        for path in (source, dest):
+            (folder, name) = os.path.split(path)
+            id_ = self._folders.get(folder)
+            if id_ is None:
+                id_ = len(self._folders)
+                self._folders[folder] = id_
+                self._picklog.dump((LOG_FOLDER, id_, folder))
+            paths += (id_, name)
+        self._picklog.dump(tuple(paths))
+
     def flush(self):
         """
         Force flush of the log file.
@@ -128,21 +261,51 @@ class Log:
         """
         Open the log to read from it.
         """
-        try:
-            self._file = open(str(self.path), "rb")
-        except FileNotFoundError:
-            import io
-            self._file = io.BytesIO()
-        finally:
-            self._picklog = pickle.Unpickler(self._file)
+        self._inputs = [open(str(path), "rb") for path in self.segments()]
+
+    def close_read(self):
+        for input_ in self._inputs:
+            input_.close()
+        self._inputs = []
 
     def read_iter(self) -> LogLine:
         """
-        Read line by line the log.
+        Read line by line the log, segments merged by time.
+        """
+        if len(self._inputs) == 1:
+            yield from self._read_segment(self._inputs[0])
+            return
+
+        segments = [self._read_keyed(index, input_)
+                    for (index, input_) in enumerate(self._inputs)]
+        for (_, _, line) in heapq.merge(*segments):
+            yield line
+
+    def _read_keyed(self, index: int, input_):
+        # sort key first, then the segment to never compare lines
+        for line in self._read_segment(input_):
+            yield (line.when, index, line)
+
+    def _read_segment(self, input_) -> LogLine:
+        for line in self._read_fields(input_):
+            yield self._make_line(line)
+
+    def read_fields(self, paths: bool=True) -> list:
+        """
+        Read the fields of each action, or the dict of each summary, segment
+        after segment, without making lines of them. Without `paths`, the
+        fields of paths are None.
+        The list yielded is reused for the next one.
         """
+        for input_ in self._inputs:
+            yield from self._read_fields(input_, paths)
+
+    def _read_fields(self, input_, full_paths: bool=True) -> list:
+        reader = pickle.Unpickler(input_)
+        paths = _PathReader(full_paths)
         line = []
         try:
-            data = self._picklog.load()
+            data = reader.load()
             assert data == MAGIC_NUMBER, ("expected the magic number at the start"
                                           "of the file")
 
@@ -150,35 +313,311 @@ class Log:
                 # look for start of action
                 if data == MAGIC_NUMBER:
                     if line:
-                        yield LogLine(line)
+                        yield line
                         line.clear()
+                elif type(data) is tuple:
+                    paths.read(data, line)
                 else:
                     line.append(data)
 
-                data = self._picklog.load()
-        except EOFError:
-            if line:
-                yield LogLine(line)
+                data = reader.load()
+        except (EOFError, pickle.UnpicklingError):
+            # the end, or an action being written by another process
+            if self._is_usable(line):
+                yield line
+
+    def read_iter_from(self, segment: Path, offset: int) -> LogLine:
+        """
+        Read line by line a segment of the log, from an offset where an
+        action starts, stopping at the first unreadable data (like after a
+        crash).
+        `self.end_offset` is updated to the end of the last readable action.
+        """
+        self.end_offset = offset
+        paths = _PathReader()
+        line = []
+        start = offset
+        with open(str(segment), "rb") as input_:
+            input_.seek(offset)
+            while True:
+                position = input_.tell()
+                try:
+                    # fields are written without memo: each one can be read
+                    # on its own
+                    data = pickle.load(input_)
+                except Exception:
+                    # half written data can fail in many ways
+                    break
+
+                if data == MAGIC_NUMBER:
+                    if line:
+                        yield self._make_line(line, start)
+                        line.clear()
+                    start = position
+                    continue
+
+                if type(data) is tuple:
+                    paths.read(data, line)
+                else:
+                    line.append(data)
+                if self._is_usable(line):
+                    self.end_offset = input_.tell()
+
+        if self._is_usable(line):
+            yield self._make_line(line, start)
+
+    @staticmethod
+    def _is_usable(data: list) -> bool:
+        # an action is usable once its paths are written
+        return (len(data) >= LOG_LINE_PATHS_END
+                or (len(data) == 1 and isinstance(data[0], dict)))
+
+    def truncate(self, offset: int):
+        """
+        Cut the segment written into at the given offset, to drop half
+        written data.
+        """
+        self._file.truncate(offset)
+
+    @staticmethod
+    def _make_line(data: list, offset: int=None):
+        # summaries are written as a single dict
+        if len(data) == 1 and isinstance(data[0], dict):
+            return SummaryLine(data[0])
+        line = LogLine(data)
+        line.offset = offset
+        return line
 
     def clear(self) -> bool:
         """
-        Makes sure the log file is removed.
+        Makes sure the log files are removed.
+        """
+        for path in self.segments():
+            if path.is_file():
+                path.unlink()
+        return not self.segments()
+
+
+class _PathReader:
+    """
+    Paths of the actions of a segment, read back into the fields of a line:
+    absolute source and dest, then source and dest.
+    """
+
+    NO_PATHS = (None,) * 4
+
+    def __init__(self, full: bool=True):
+        self.cwd = ""
+        # prefixes of names in a folder, relative and absolute, by id
+        self.folders = {}
+        # else paths are not rebuilt, only their fields are filled
+        self.full = full
+
+    def read(self, data: tuple, line: list):
+        """
+        Read data about paths, into the line if they are the ones of an
+        action.
+        """
+        if data[0] == LOG_SESSION:
+            self.cwd = data[1]
+            self.folders = {}
+        elif data[0] == LOG_FOLDER:
+            prefix = os.path.join(data[2], "")
+            self.folders[data[1]] = (prefix, os.path.join(self.cwd, prefix))
+        elif not self.full:
+            line += self.NO_PATHS
+        else:
+            (source, abs_source) = self.folders[data[0]]
+            (dest, abs_dest) = self.folders[data[2]]
+            line += (abs_source + data[1], abs_dest + data[3],
+                     source + data[1], dest + data[3])
+
+
+class Plan:
+    """
+    Renames computed ahead, to apply later or on another machine.
+    Each step is a tuple (source, dest, rule id), written one at a time.
+    Steps for the same source follow each other, in the order to try them.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+
+    def open_write(self):
+        """
+        Create the plan to write steps into it.
+        """
+        self._file = open(str(self.path), "wb")
+        pickle.dump(PLAN_MAGIC_NUMBER, self._file, pickle.DEFAULT_PROTOCOL)
+
+    def close_write(self):
+        """
+        Flush the plan and disable writing.
+        """
+        self._file.flush()
+        self._file.close()
+        self._file = None
+
+    def write(self, source: str, dest: str, rule_id: str):
+        """
+        Append a step to the plan.
+        """
+        # each step is pickled alone, so nothing is kept in memory
+        pickle.dump((source, dest, rule_id), self._file,
+                    pickle.DEFAULT_PROTOCOL)
+
+    def read_iter(self) -> (str, str, str):
+        """
+        Read step by step the plan.
+        """
+        with open(str(self.path), "rb") as input_:
+            try:
+                data = pickle.load(input_)
+            except EOFError:
+                data = None
+            if data != PLAN_MAGIC_NUMBER:
+                raise RuntimeError("not a plan file: {}".format(self.path))
+
+            # kept to tell how far it was read
+            self._file = input_
+            try:
+                while True:
+                    try:
+                        yield pickle.load(input_)
+                    except EOFError:
+                        break
+            finally:
+                self._file = None
+
+    def read_fraction(self) -> float:
+        """
+        Part of the plan read so far, from 0 to 1.
+        """
+        if self._file is None:
+            return 0
+        return self._file.tell() / max(self.path.stat().st_size, 1)
+
+
+class Cursor:
+    """
+    State of a rename in progress, to resume it after a crash.
+    It holds the command and its arguments, and where its actions start in
+    the segment of the action log it writes into: the log tells how far it
+    went.
+    """
+
+    def __init__(self, segment: Path):
+        self.segment = segment
+        self.path = Path(str(segment) + ".cursor")
+
+    def save(self, command: str, args: dict, log_offset: int):
+        """
+        Save the state, replacing the previous one at once.
+        """
+        replace_file(self.path, lambda output: pickle.dump({
+            "command": command,
+            "args": args,
+            "log_offset": log_offset
+        }, output, pickle.DEFAULT_PROTOCOL))
+
+    def load(self) -> dict:
+        """
+        Load the state, None if there is nothing to resume.
         """
-        if not self.path.exists():
-            return True
-        elif self.path.is_file():
+        try:
+            with open(str(self.path), "rb") as input_:
+                return pickle.load(input_)
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        try:
             self.path.unlink()
-        return not self.path.exists()
+        except FileNotFoundError:
+            pass
+
+
+class Created:
+    """
+    Files created by the renames of a run, not to rename them again when
+    the run is resumed.
+    Renames follow the order of a sorted scan, which never comes back into
+    a folder it left: files created in it are forgotten once it is left,
+    and others once scanned, so memory does not grow with the run.
+    """
+
+    def __init__(self):
+        # names of files created, by folder
+        self._names = {}
+        # folder of the last source passed
+        self._folder = None
+
+    def add(self, path: str):
+        (folder, name) = os.path.split(path.rstrip(os.sep))
+        self._names.setdefault(folder, set()).add(name)
+
+    def passed(self, source: str):
+        """
+        Forget the folders the scan left before reaching the source.
+        """
+        folder = os.path.dirname(source.rstrip(os.sep))
+        left = self._folder
+        self._folder = folder
+        if left is None or _is_inside(folder, left):
+            return
+        for created_in in [f for f in self._names if _is_inside(f, left)]:
+            del self._names[created_in]
+
+    def pop(self, path: str) -> bool:
+        """
+        Tell if the path is a file created, forgetting it.
+        """
+        (folder, name) = os.path.split(path.rstrip(os.sep))
+        names = self._names.get(folder)
+        if not names or name not in names:
+            return False
+        names.remove(name)
+        if not names:
+            del self._names[folder]
+        return True
+
+    def __len__(self) -> int:
+        return sum(len(names) for names in self._names.values())
+
+
+def _is_inside(path: str, folder: str) -> bool:
+    # paths relative to the current folder are all inside ''
+    return (not folder
+            or path == folder
+            or path.startswith(folder + os.sep))
 
 
 class Renamer:
     """
     Class to rename/move files.
     All actions are logged into a file prior and after execution.
+    File system calls are paced by `throttle`, if given.
     """
 
-    def __init__(self, log: Log):
+    # file system calls of a rename: mkdir and rename
+    RENAME_COST = 2
+
+    # errors failing a rename alone, like moving a folder into itself or
+    # onto a folder not empty
+    RENAME_ERRORS = (errno.EINVAL, errno.ENOTEMPTY, errno.EEXIST)
+
+    def __init__(self, log: Log, throttle: RateLimiter=None):
         self.log = log
+        self.throttle = throttle
+        # paths are absolute from the folder the application was started in
+        self._cwd = os.getcwd()
+        # folders of the last renames, kept open
+        self._folders = FolderFds() if FolderFds.supported else None
+
+    def close(self):
+        if self._folders:
+            self._folders.clear()
 
     def _dump_log_before(self,
                          source: Path,
@@ -195,17 +634,22 @@ class Renamer:
         self.log.write(str(rule_id))
         self.log.write(int(mode))
 
-        # files to rename, as in absolute (their real path) and
-        # as they were seen
-        self.log.write(str(source.absolute()))
-        self.log.write(str(dest.absolute()))
-        self.log.write(str(source))
-        self.log.write(str(dest))
+        # files to rename, as they were seen, from where the application
+        # was started to know their real path
+        self.log.write_paths(self._cwd, str(source), str(dest))
 
     def _dump_log_after(self, success: bool):
         self.log.write(success)
         self.log.flush()
 
+    def record_result(self, success: bool):
+        """
+        Log the result of the action the log ends with, done before it
+        stopped.
+        """
+        assert self.log and self.log.ready_to_write
+        self._dump_log_after(success)
+
     def rename(self,
                source: Path,
                dest: Path,
@@ -218,22 +662,116 @@ class Renamer:
                               action_mode)
 
         try:
-            if action_mode.was_renamed:
-                if dest.exists():
-                    logger.warn("File already exists: {}".format(dest))
-                    return False
-
-                # make sure folder exists if it was changed
-                dest.parent.mkdir(parents=True, exist_ok=True)
-                # move or rename file
-                source.rename(dest)
-
             result = True
+            if action_mode.was_renamed:
+                if self.throttle:
+                    result = self.throttle.run(self._move, source, dest,
+                                               cost=self.RENAME_COST)
+                else:
+                    result = self._move(source, dest)
+                if result and action_mode.is_folder and self._folders:
+                    # open folders may be in the one moved
+                    self._folders.clear()
         except FileNotFoundError:
             logger.warn("File not found: {}".format(source))
             result = False
+        except OSError as error:
+            if error.errno not in self.RENAME_ERRORS:
+                raise
+            logger.warn("Cannot rename {}: {}".format(source, error.strerror))
+            result = False
 
         self._dump_log_after(result)
 
         return result
 
+    def _move(self, source: Path, dest: Path) -> bool:
+        try:
+            if self._folders:
+                try:
+                    self._move_in_folders(source, dest)
+                except FileNotFoundError:
+                    # open folders may have been moved by another process
+                    self._folders.clear()
+                    self._move_in_folders(source, dest)
+            else:
+                # make sure folder exists if it was changed
+                if dest.parent != source.parent:
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                # move or rename file, unless the destination exists
+                rename_noreplace(str(source), str(dest))
+        except FileExistsError:
+            logger.warn("File already exists: {}".format(dest))
+            return False
+        return True
+
+    def _move_in_folders(self, source: Path, dest: Path):
+        # the folder is created if it was changed, opening its parents: it
+        # is opened first, not to close the source one
+        (dst_folder, dst_name) = os.path.split(str(dest))
+        (src_folder, src_name) = os.path.split(str(source))
+        dst_dir_fd = self._folders.open(dst_folder or os.curdir, True)
+        src_dir_fd = self._folders.open(src_folder or os.curdir)
+        rename_noreplace(src_name, dst_name,
+                         src_dir_fd=src_dir_fd,
+                         dst_dir_fd=dst_dir_fd)
+
+
+
+class Summarizer:
+    """
+    Replacement of Renamer for simulations: nothing is renamed, and a single
+    summary of the run is written in the log at the end.
+    """
+
+    def __init__(self, log: Log, examples: int=0):
+        self.log = log
+        self.when = datetime.datetime.now()
+        self.mode = None
+        self.counts = {}
+        # reservoir sampling of renames
+        self.examples_size = examples
+        self.examples = []
+        self._seen = 0
+
+    def rename(self,
+               source: Path,
+               dest: Path,
+               rule_id: str,
+               action_mode: ActionFlag) -> bool:
+        assert action_mode.is_simulated
+        if self.mode is None:
+            self.mode = ActionFlag(action_mode & ~ActionFlag.USER_ENTRY)
+
+        self.counts[rule_id] = self.counts.get(rule_id, 0) + 1
+
+        self._seen += 1
+        example = (str(rule_id), str(source), str(dest))
+        if len(self.examples) < self.examples_size:
+            self.examples.append(example)
+        else:
+            index = random.randrange(self._seen)
+            if index < self.examples_size:
+                self.examples[index] = example
+
+        return True
+
+    def write_summary(self):
+        """
+        Write the summary in the log.
+        """
+        assert self.log and self.log.ready_to_write
+        mode = self.mode
+        if mode is None:
+            mode = ActionFlag.from_(user_given_entry=False,
+                                    rule_is_manual=False,
+                                    simulation=True)
+
+        self.log.write(MAGIC_NUMBER)
+        self.log.write({
+            "when": str(self.when.isoformat()),
+            "mode": int(mode),
+            "counts": self.counts,
+            "examples": self.examples
+        })
+        self.log.flush()
@@ -3,10 +3,12 @@ import re
 import itertools
 import hashlib
 import datetime
-from pathlib import Path
+import time
+import os
 import string
 
 import logger
+import content
 from utils import *
 
 
@@ -25,9 +27,168 @@ class FileFormatter(string.Formatter):
             return action(value)
         return super(FileFormatter, self).convert_field(value, conversion)
 
+    def conversion(self, conversion):
+        """
+        Return the callable applied for the given conversion, or None.
+        """
+        if conversion is None:
+            return None
+        action = self._conversions.get(conversion, None)
+        if action:
+            return action
+        return lambda value: super(FileFormatter, self).convert_field(
+            value, conversion)
+
 file_formatter = FileFormatter()
 
 
+class Template:
+    """
+    Rename format parsed once into a list of literal and field operations.
+
+    Only simple fields (auto-numbered, positional or named, with a conversion
+    and a plain format spec) are compiled. Anything else (attribute or index
+    access, nested format spec, invalid syntax) falls back to the formatter.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        try:
+            self._ops = self._compile(text)
+        except ValueError:
+            # let the formatter raise the error when the template is used
+            self._ops = None
+        self.content_fields = self._content_fields(text)
+
+    @staticmethod
+    def _content_fields(text: str) -> frozenset:
+        """
+        Content fields (like 'sha1') used by the template.
+        """
+        try:
+            names = {re.match(r"\w*", field).group()
+                     for (_, field, _, _) in file_formatter.parse(text)
+                     if field}
+        except ValueError:
+            return frozenset()
+        return frozenset(names & content.FIELDS)
+
+    @staticmethod
+    def _compile(text: str) -> list:
+        ops = []
+        auto_index = 0
+        manual = False
+        automatic = False
+
+        for (literal, field, spec, conversion) in file_formatter.parse(text):
+            if literal:
+                ops.append((literal, None, None, None))
+            if field is None:
+                continue
+
+            if field == "":
+                if manual:
+                    return None
+                automatic = True
+                field = auto_index
+                auto_index += 1
+            elif field.isdigit():
+                if automatic:
+                    return None
+                manual = True
+                field = int(field)
+            elif not field.isidentifier():
+                return None
+
+            if "{" in spec:
+                return None
+
+            ops.append((None,
+                        field,
+                        file_formatter.conversion(conversion),
+                        spec))
+
+        return ops
+
+    def format(self, args: tuple, kwargs: dict) -> str:
+        if self._ops is None:
+            return file_formatter.format(self.text, *args, **kwargs)
+
+        parts = []
+        for (literal, field, convert, spec) in self._ops:
+            if literal is not None:
+                parts.append(literal)
+                continue
+
+            value = (args[field]
+                     if isinstance(field, int)
+                     else kwargs[field])
+            if convert:
+                value = convert(value)
+            parts.append(format(value, spec))
+
+        return "".join(parts)
+
+
+# end of a pattern only matching names with the given suffix(es), like
+# '\.mkv$', '\.(mkv|avi)$', '\.(?:mkv|avi)$' or '\.(?P<ext>mkv|avi)$'
+_SUFFIX_END = re.compile(r"\\\.(\((?:\?:|\?P<\w+>)?)?"
+                         r"(?P<suffixes>[A-Za-z0-9_|-]+)(?(1)\))\$$")
+
+
+def _has_top_level_alternative(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    escaped = False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif in_class:
+            in_class = (c != "]")
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+    return False
+
+
+def derive_suffixes(identifier: re.compile) -> frozenset:
+    """
+    Suffixes (casefolded, with the dot) of the names the identifier can match,
+    found from the end of the pattern.
+    Return None if the pattern can match any suffix.
+    """
+    pattern = identifier.pattern
+    if not isinstance(pattern, str):
+        return None
+    # '$' also matches before newlines, and spaces are ignored when verbose
+    if identifier.flags & (re.MULTILINE | re.VERBOSE):
+        return None
+    if _has_top_level_alternative(pattern):
+        return None
+
+    end = _SUFFIX_END.search(pattern)
+    if not end:
+        return None
+
+    # escaped backslash before the dot: not an escaped dot
+    start = end.start()
+    backslashes = len(pattern[:start]) - len(pattern[:start].rstrip("\\"))
+    if backslashes % 2:
+        return None
+
+    suffixes = end.group("suffixes").split("|")
+    if not all(suffixes):
+        return None
+    return frozenset("." + suffix.casefold() for suffix in suffixes)
+
+
 class Rule:
     """
     Rule for name identification and renaming.
@@ -36,6 +197,7 @@ class Rule:
     def __init__(self, identify:str, rename: str, guid=None):
         self.identifier = re.compile(identify)
         self.renamer = rename
+        self.template = Template(rename)
         self.guid = guid
         self.name = None
 
@@ -49,6 +211,34 @@ class Rule:
         # ...
         self.height = 0
 
+        # rules with higher priority are always tried first
+        self.priority = 0
+
+        # statistics of matching, to order rules by expected payoff
+        self.tries = 0
+        self.hits = 0
+        self.match_time = 0.0
+
+        # rule disabled after a match took more than the time budget
+        self.quarantined = False
+
+        # rule renaming folders at once, instead of files
+        self.folder = False
+
+        # suffixes of the files the rule is tried on, None for all
+        self.declared_suffixes = None
+        self._derived_suffixes = derive_suffixes(self.identifier)
+
+    @property
+    def suffixes(self) -> frozenset:
+        """
+        Suffixes (casefolded) of files the rule can apply on, declared or
+        derived from the identifier. None if it can apply on any file.
+        """
+        if self.declared_suffixes is not None:
+            return self.declared_suffixes
+        return self._derived_suffixes
+
     def name_prefix(self):
         if self.name:
             return "{}:{}".format(self.guid, self.name)
@@ -62,6 +252,34 @@ class Rule:
     def renamer_as_text(self):
         return self.renamer
 
+    @property
+    def match_cost(self) -> float:
+        """
+        Average time of a match, in nanoseconds.
+        """
+        if self.tries:
+            return self.match_time * 1e9 / self.tries
+        return 0.0
+
+    @property
+    def payoff(self) -> float:
+        """
+        Expected matches per nanosecond spent to try the rule.
+        Rules never tried get the best payoff, to be tried first.
+        """
+        if not self.tries:
+            return float("inf")
+        hit_rate = (self.hits + 1) / (self.tries + 2)
+        return hit_rate / max(self.match_cost, 1.0)
+
+    def record(self, hit: bool, duration: float):
+        """
+        Add a try of the rule to its statistics.
+        """
+        self.tries += 1
+        self.hits += hit
+        self.match_time += duration
+
     def __eq__(self, other):
         if isinstance(other, Rule):
             return self.guid == other.guid
@@ -70,29 +288,32 @@ class Rule:
     def __hash__(self):
         return hash(self.guid)
 
-    def analysed_path(self, path: Path) -> Path:
-        try:
-            return path.relative_to(path.parents[self.height])
-        except IndexError:
-            # if height is too much for the path, the rule cannot be applied
-            pass
+    def analysed_path(self, path: str) -> str:
+        # if height is too much for the path, the rule cannot be applied
+        parts = split_parents(path, self.height)
+        if parts:
+            return parts[1]
 
-    def untouched_root(self, path: Path) -> Path:
-        try:
-            return path.parents[self.height]
-        except IndexError:
-            # if height is too much for the path, the rule cannot be applied
-            pass
+    def untouched_root(self, path: str) -> str:
+        # if height is too much for the path, the rule cannot be applied
+        parts = split_parents(path, self.height)
+        if parts:
+            return parts[0]
 
-    def match(self, path: Path):
+    def match(self, path: str):
         text = self.analysed_path(path)
         if text:
-            return self.identifier.search(str(text))
+            return self.identifier.search(text)
 
-    def format(self, path: Path, match: re.match):
+    def format(self,
+               path: str,
+               match: re.match,
+               fields: content.ContentFields=None) -> str:
         """
         Format the path with the result of the matching.
         Only replace what was captured.
+        Content fields of the template come from `fields`, unless captured
+        with the same name.
         """
         assert match is not None
 
@@ -100,13 +321,23 @@ class Rule:
         prefix = match.string[:match.start()]
         suffix = match.string[match.end():]
 
-        updated_name = file_formatter.format(
-            self.renamer,
-            None,
-            *match.groups(),
-            **match.groupdict())
+        kwargs = match.groupdict()
+        needed = self.template.content_fields.difference(kwargs)
+        if needed:
+            kwargs.update((fields or content.ContentFields()).fields(
+                path, needed))
+
+        updated_name = self.template.format(
+            (None,) + match.groups(),
+            kwargs)
+
+        # the analysed text is the end of the path, the rest is untouched
+        root = path[:len(path) - len(match.string)]
+        return os.path.join(root, prefix + updated_name + suffix)
 
-        return self.untouched_root(path) / Path(prefix + updated_name + suffix)
+
+# matches of a rule over the budget, in a run, putting it in quarantine
+OVERRUNS = 3
 
 
 class Rules:
@@ -118,11 +349,95 @@ class Rules:
         # list of Rule
         self.rules = {}
 
+        # order in which rules are tried, computed when needed,
+        # and the same for each suffix of files
+        self._order = None
+        self._by_suffix = {}
+        self._for_folders = None
+        self.adaptive = False
+
+        # update statistics of rules when they are tried
+        self.record_stats = False
+
+        # time (in seconds) above which a match is an overrun of its rule,
+        # put in quarantine after OVERRUNS of them
+        self.budget = None
+        self._overruns = {}
+
+        # rules were changed, and should be saved
+        self.dirty = False
+
+        # guids of the rules when last loaded or saved, telling the ones
+        # added meanwhile by other processes
+        self.stored_guids = None
+
+    def use_adaptive_order(self, enabled: bool=True):
+        """
+        Try rules by expected payoff (after their priority), based on
+        their statistics.
+        """
+        self.adaptive = enabled
+        self._reset_order()
+
+    def ordered(self) -> [Rule]:
+        """
+        Rules in the order they are tried: by priority, then by expected
+        payoff if adaptive, then in the order they were added.
+        """
+        if self._order is None:
+            if self.adaptive:
+                key = lambda r: (-r.priority, -r.payoff)
+            else:
+                key = lambda r: -r.priority
+            self._order = sorted((r for r in self.rules.values()
+                                  if not r.quarantined),
+                                 key=key)
+        return self._order
+
+    def for_suffix(self, suffix: str) -> [Rule]:
+        """
+        Rules that can apply on files with the suffix, in order.
+        """
+        rules = self._by_suffix.get(suffix, None)
+        if rules is None:
+            rules = [r for r in self.ordered()
+                     if not r.folder
+                     and (r.suffixes is None or suffix in r.suffixes)]
+            self._by_suffix[suffix] = rules
+        return rules
+
+    def for_folders(self) -> [Rule]:
+        """
+        Rules that rename folders, in order.
+        """
+        if self._for_folders is None:
+            self._for_folders = [r for r in self.ordered() if r.folder]
+        return self._for_folders
+
+    def _reset_order(self):
+        self._order = None
+        self._by_suffix = {}
+        self._for_folders = None
+
+    def quarantined(self) -> [Rule]:
+        """
+        Rules not tried, as they were put in quarantine.
+        """
+        return [r for r in self.rules.values() if r.quarantined]
+
+    def quarantine(self, rule: Rule, enabled: bool=True):
+        rule.quarantined = enabled
+        self._reset_order()
+        self.dirty = True
+
     def add(self, id_rule: str,
             rename_rule: str,
             guid=None,
             name: str=None,
-            height: int=0) -> bool:
+            height: int=0,
+            priority: int=0,
+            suffixes: (str,)=None,
+            folder: bool=False) -> bool:
 
         if height < 0:
             logger.warn("height is negative: maybe later this will be used"
@@ -133,16 +448,17 @@ class Rules:
         rule.name = name
         rule.guid = guid
         rule.height = height
+        rule.priority = priority
+        rule.folder = folder
+        if suffixes:
+            rule.declared_suffixes = frozenset(
+                ("" if x.startswith(".") else ".") + x.casefold()
+                for x in suffixes)
         logger.info("add rule {}".format(rule.guid))
 
         # create guid if this is a new rule
         if guid is None:
-            while guid is None or guid in self.rules:
-                m = hashlib.sha1()
-                m.update(id_rule.encode("utf8"))
-                m.update(rename_rule.encode("utf8"))
-                m.update(datetime.datetime.today().isoformat().encode("utf8"))
-                guid = m.hexdigest()[:12]
+            guid = self.new_guid(id_rule, rename_rule)
             rule.guid = guid
             logger.info("create id '{}' for rule".format(guid))
         elif guid in self.rules:
@@ -150,8 +466,22 @@ class Rules:
             return
 
         self.rules[rule.guid] = rule
+        self._reset_order()
         return rule
 
+    def new_guid(self, id_rule: str, rename_rule: str) -> str:
+        """
+        Create a guid for a rule, that none of the rules has.
+        """
+        guid = None
+        while guid is None or guid in self.rules:
+            m = hashlib.sha1()
+            m.update(id_rule.encode("utf8"))
+            m.update(rename_rule.encode("utf8"))
+            m.update(datetime.datetime.today().isoformat().encode("utf8"))
+            guid = m.hexdigest()[:12]
+        return guid
+
     def remove(self, guid=None, name=None) -> bool:
         logger.info("remove rule {} or {}".format(guid, name))
         rule = self.rules.pop(guid, None)
@@ -166,15 +496,61 @@ class Rules:
                 return False
 
         logger.info("found rule {}".format(guid))
+        self._reset_order()
         return True
 
-    def find_applying(self, path: Path, name_or_id: str=None) -> ((Rule, re.match)):
-        items = iter(self.rules.values())
+    def set_priority(self, rule: Rule, priority: int):
+        rule.priority = priority
+        self._reset_order()
+
+    def find(self, guid_or_name: str) -> Rule:
+        rule = self.rules.get(guid_or_name, None)
+        if rule is None:
+            rule = self._find_name(guid_or_name)
+        return rule
+
+    def find_applying(self, path: str, name_or_id: str=None) -> ((Rule, re.match)):
+        """
+        Yield (rule, path, match) for rules applying on the path.
+        Paths ending with a separator are folders, only tried with folder
+        rules (and yielded without the separator).
+        """
+        if path.endswith(os.sep):
+            path = path.rstrip(os.sep)
+            items = iter(self.for_folders())
+        else:
+            # only rules that can apply on the suffix of the file are tried
+            # from the last dot, unlike splitext even for names like '.mkv'
+            name = os.path.basename(path)
+            dot = name.rfind(".")
+            suffix = name[dot:].casefold().rstrip("\n") if dot >= 0 else ""
+            items = iter(self.for_suffix(suffix))
         if name_or_id:
             items = filter(lambda r: name_or_id in (r.name, r.guid), items)
 
+        timed = self.record_stats or self.budget
+
         for rule in items:
-            match = rule.match(path)
+            if timed:
+                start = time.perf_counter()
+                match = rule.match(path)
+                duration = time.perf_counter() - start
+
+                if self.record_stats:
+                    rule.record(bool(match), duration)
+                if self.budget and duration > self.budget:
+                    # a single slow match may be a pause of the process
+                    overruns = self._overruns.get(rule.guid, 0) + 1
+                    self._overruns[rule.guid] = overruns
+                    logger.warn("rule {} took {:.0f} ms on {} ({}/{})".format(
+                        rule.guid, duration * 1e3, path, overruns, OVERRUNS))
+                    if overruns >= OVERRUNS:
+                        logger.warn("rule {} put in quarantine".format(
+                            rule.guid))
+                        self.quarantine(rule)
+                        continue
+            else:
+                match = rule.match(path)
             if match:
                 yield (rule, path, match)
 
@@ -23,6 +23,10 @@ confs = tuple(Path(c).expanduser() for c in confs)
 
 DEFAULT_RULE_DB_PATH = Path(".priv/rules")
 DEFAULT_ACTION_LOG_PATH = Path(".priv/action_log")
+DEFAULT_HASH_CACHE_PATH = Path(".priv/hash_cache")
+
+# how simulations are logged: every rename, or a summary of the run
+SIMULATION_LOGS = ("full", "summary")
 
 
 class Conf:
@@ -30,6 +34,12 @@ class Conf:
         self.path = None
         self.rule_db_path = DEFAULT_RULE_DB_PATH
         self.actlog_path = DEFAULT_ACTION_LOG_PATH
+        # digests of files for content fields
+        self.hash_cache_path = DEFAULT_HASH_CACHE_PATH
+        # folder names (globs or 're:' regexes) never scanned
+        self.exclude = ()
+        # how simulations are logged: 'full' or 'summary'
+        self.simulation_log = "full"
 
 
 def abspath_from_conf(cf_path: Path, path: Path):
@@ -38,6 +48,15 @@ def abspath_from_conf(cf_path: Path, path: Path):
             else cf_path.parent.joinpath(path)).resolve()
 
 
+def choice_from_conf(cf_path: Path, key: str, value: str,
+                     choices: tuple) -> str:
+    value = value.strip().lower()
+    if value not in choices:
+        raise ValueError("invalid {} '{}' in {}, expected one of: {}".format(
+            key, value, cf_path, ", ".join(choices)))
+    return value
+
+
 def load_conf(cf_path: Path):
     logger.info("load config file {}".format(cf_path))
     if not cf_path:
@@ -60,6 +79,22 @@ def load_conf(cf_path: Path):
                                         fallback=conf.actlog_path)
     conf.actlog_path = abspath_from_conf(cf_path, Path(actlog_path))
 
+    hash_cache_path = config["DEFAULT"].get("hash_cache",
+                                            fallback=conf.hash_cache_path)
+    conf.hash_cache_path = abspath_from_conf(cf_path, Path(hash_cache_path))
+
+    # folders to skip when scanning, one per line or separated by commas
+    exclude = config["DEFAULT"].get("exclude", fallback="")
+    conf.exclude = tuple(p.strip()
+                         for line in exclude.splitlines()
+                         for p in line.split(",")
+                         if p.strip())
+
+    simulation_log = config["DEFAULT"].get("simulation_log",
+                                           fallback=conf.simulation_log)
+    conf.simulation_log = choice_from_conf(cf_path, "simulation_log",
+                                           simulation_log, SIMULATION_LOGS)
+
     return conf
 
 
@@ -73,6 +108,10 @@ def save_conf(conf: Conf):
     config = configparser.ConfigParser()
     config["DEFAULT"]["rules_db"] = str(conf.rule_db_path)
     config["DEFAULT"]["action_log"] = str(conf.actlog_path)
+    config["DEFAULT"]["hash_cache"] = str(conf.hash_cache_path)
+    if conf.exclude:
+        config["DEFAULT"]["exclude"] = "\n".join(conf.exclude)
+    config["DEFAULT"]["simulation_log"] = conf.simulation_log
 
     with open(str(conf.path), "w") as output:
         config.write(output)
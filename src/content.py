@@ -0,0 +1,159 @@
+"""
+Fields of rename templates taken from the file itself, not its name.
+
+    {size}          size in bytes
+    {mtime}         last modification, as a datetime ({mtime:%Y-%m-%d})
+    {sha1}, {md5}   hexadecimal digest of the content ({sha1:8} keeps the
+                    first 8 characters)
+
+Digests are kept in a cache, saved between runs, keyed on the device, inode,
+size and modification time of the file: a file is hashed again only if it
+changed.
+"""
+
+import os
+import pickle
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import logger
+from utils import replace_file
+
+
+DIGESTS = ("sha1", "md5")
+FIELDS = frozenset(DIGESTS + ("size", "mtime"))
+
+# size of the reads while hashing
+READ_SIZE = 1024 * 1024
+
+# files hashed at once
+WORKERS = 4
+
+
+class Digest(str):
+    """
+    Hexadecimal digest, where a number as format spec keeps the first
+    characters.
+    """
+
+    def __format__(self, spec: str) -> str:
+        if spec.isdigit():
+            return self[:int(spec)]
+        return super().__format__(spec)
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    """
+    Digest of the content of the file, read by large blocks.
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as input_:
+        while True:
+            size = input_.readinto(buffer)
+            if not size:
+                break
+            # the lock of the interpreter is released while hashing
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+class ContentFields:
+    """
+    Compute content fields of files, with the cache of their digests.
+    """
+
+    def __init__(self, cache_path: Path=None):
+        self.cache_path = cache_path
+        # digests by (st_dev, st_ino, st_size, st_mtime_ns) then by algorithm
+        self._cache = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._executor = None
+        # digests being computed, by (path, algorithm)
+        self._pending = {}
+
+    def load(self):
+        """
+        Load the cache of digests.
+        """
+        if self.cache_path is None:
+            return
+        try:
+            with open(str(self.cache_path), "rb") as input_:
+                self._cache = pickle.load(input_)
+        except FileNotFoundError:
+            return
+        except (EOFError, pickle.UnpicklingError):
+            logger.warn("invalid hash cache {}, start a new one".format(
+                self.cache_path))
+        logger.info("Loaded {} cached digest(s)".format(len(self._cache)))
+
+    def close(self):
+        """
+        Wait for digests being computed, and save the new ones.
+        """
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        self._pending.clear()
+
+        if not self._dirty or self.cache_path is None:
+            return
+        # keep digests saved meanwhile by other processes
+        cache = self._cache
+        self._cache = {}
+        self.load()
+        self._cache.update(cache)
+        replace_file(self.cache_path,
+                     lambda output: pickle.dump(self._cache, output,
+                                                pickle.DEFAULT_PROTOCOL))
+        self._dirty = False
+
+    @staticmethod
+    def _key(stat: os.stat_result) -> tuple:
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _digest(self, path: str, algorithm: str, stat: os.stat_result) -> str:
+        key = self._key(stat)
+        with self._lock:
+            digest = self._cache.get(key, {}).get(algorithm)
+        if digest is None:
+            digest = hash_file(path, algorithm)
+            with self._lock:
+                self._cache.setdefault(key, {})[algorithm] = digest
+                self._dirty = True
+        return digest
+
+    def prefetch(self, path: str, names: set):
+        """
+        Start to compute the digests among the fields, in the background.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=WORKERS)
+        for algorithm in names.intersection(DIGESTS):
+            if (path, algorithm) not in self._pending:
+                self._pending[(path, algorithm)] = self._executor.submit(
+                    self._digest, path, algorithm, os.stat(path))
+
+    def fields(self, path: str, names: set) -> dict:
+        """
+        Values of the content fields among the names, for the file.
+        """
+        stat = os.stat(path)
+        values = {}
+        for name in names:
+            if name == "size":
+                values[name] = stat.st_size
+            elif name == "mtime":
+                values[name] = datetime.datetime.fromtimestamp(stat.st_mtime)
+            elif name in DIGESTS:
+                pending = self._pending.pop((path, name), None)
+                values[name] = Digest(pending.result()
+                                      if pending
+                                      else self._digest(path, name, stat))
+        return values
@@ -0,0 +1,305 @@
+"""
+Rename files from Python, without the command line.
+
+The engine keeps rules compiled and the action log open from one batch of
+paths to the next:
+
+    engine = Engine.load(Path(".priv/rules"))
+    engine.start_action(Path(".priv/action_log"))
+    for result in engine.rename(scan_fs(["incoming"], recursive=True)):
+        if not result.success:
+            ...
+    engine.end_action()
+
+Paths are given and returned as strings, folders with a trailing separator.
+Results are generators: files are renamed as results are read.
+"""
+
+import os
+import collections
+from collections import namedtuple
+from pathlib import Path
+
+import logger
+import book
+import well
+import action
+import content
+from utils import RateLimiter
+
+
+# rename found by rules, not done yet
+Step = namedtuple("Step", ("source", "dest", "rule_id"))
+
+# rename done (or simulated)
+Result = namedtuple("Result", ("source", "dest", "rule_id", "mode",
+                               "success"))
+
+
+class Engine:
+    """
+    Rules and action log used to rename files.
+    """
+
+    # paths matched ahead, to hash the content of files meanwhile
+    READ_AHEAD = 64
+
+    # candidates of folders taken kept until renamed, the oldest ones being
+    # matched again if they come after
+    FOLDERS_TAKEN = 1024
+
+    # answers of the confirmation asked before each rename
+    ACCEPT      = 1
+    DISCARD     = 2
+    SKIP_FILE   = 3
+    STOP_ACTION = 4
+
+    def __init__(self, rules: book.Rules=None):
+        self.rules = rules
+        self.rule_path = None
+        self.renamer = None
+        self.action_log = None
+        self._rename_file = None
+        # set when the user asked to stop
+        self.abort = False
+        # candidates of folders taken while scanning, until renamed, in the
+        # order they were taken
+        self._folder_candidates = collections.OrderedDict()
+        # content fields of files, if rules use them
+        self.content = None
+        # rules applying on paths read ahead, until formatted
+        self._matches = {}
+
+    @classmethod
+    def load(cls, rule_path: Path) -> "Engine":
+        """
+        Engine with the rules of a database.
+        """
+        engine = cls()
+        engine.load_rules(rule_path)
+        return engine
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.end_action()
+
+    def phony_rules(self):
+        self.rules = book.Rules()
+
+    def load_rules(self, filepath: Path):
+        self.rule_path = filepath
+        self.rules = well.load_rules(filepath)
+
+    def save_rules(self):
+        if self.rule_path:
+            well.save_rules(self.rule_path, self.rules)
+        else:
+            logger.warn("no path of database to save rules")
+
+    def set_action_log(self, path: Path):
+        self.action_log = action.Log(path)
+
+    def open_action_log(self, actlog_path: Path):
+        self.set_action_log(actlog_path)
+        self.action_log.open_read()
+
+    def start_action(self,
+                     actlog_path: Path,
+                     silent: bool=False,
+                     summary_examples: int=None,
+                     log: action.Log=None,
+                     throttle: RateLimiter=None):
+        """
+        Prepare to rename files, logging into the action log, or into `log`
+        if it is already open to write.
+        For simulations, if `summary_examples` is given, only a summary with
+        at most this number of examples is logged.
+        Renames are paced by `throttle`, if given.
+        """
+        if silent:
+            self._rename_file = lambda *_: True
+            return
+
+        if log is None:
+            log = action.Log(actlog_path)
+            log.open_write()
+        self.action_log = log
+        if summary_examples is not None:
+            self.renamer = action.Summarizer(self.action_log,
+                                             summary_examples)
+        else:
+            self.renamer = action.Renamer(self.action_log, throttle)
+        self._rename_file = self.renamer.rename
+
+    def use_content(self, cache_path: Path):
+        """
+        Compute content fields with the cache of digests, if rules use them.
+        """
+        if any(r.template.content_fields for r in self.rules):
+            self.content = content.ContentFields(cache_path)
+            self.content.load()
+
+    def end_action(self):
+        if self.content:
+            self.content.close()
+
+        if not self.action_log or not self.action_log.ready_to_write:
+            return
+
+        if isinstance(self.renamer, action.Summarizer):
+            self.renamer.write_summary()
+        else:
+            self.renamer.close()
+
+        self._rename_file = None
+        self.renamer = None
+        self.action_log.close_write()
+
+    def reformat(self, path: str, rule_id_or_name: str=None) -> (book.Rule,
+                                                                 str):
+        """
+        Yield (rule, new path) for each rule applying on the path.
+        """
+        matches = self._matches.pop(path, None)
+        if matches is None:
+            matches = self.rules.find_applying(path, rule_id_or_name)
+
+        for (rule, path, match) in matches:
+            try:
+                new_path = rule.format(path, match, self.content)
+            except OSError as error:
+                # content fields could not be read
+                logger.warn("cannot read {}: {}".format(path, error))
+                continue
+            yield (rule, new_path)
+
+    def read_ahead(self,
+                   items: iter,
+                   rule_id_or_name: str=None,
+                   key: callable=None) -> iter:
+        """
+        Iterate over the items (paths, or anything `key` gives a path of),
+        matched ahead: the content fields rules need are computed in the
+        background meanwhile.
+        """
+        if self.content is None:
+            return iter(items)
+        return self._read_ahead(items, rule_id_or_name, key)
+
+    def _read_ahead(self, items, rule_id_or_name, key):
+        window = collections.deque()
+        for item in items:
+            path = key(item) if key else item
+            # folders were matched while scanning
+            if not path.endswith(os.sep):
+                matches = list(self.rules.find_applying(path,
+                                                        rule_id_or_name))
+                self._matches[path] = matches
+                for (rule, _, _) in matches:
+                    if rule.template.content_fields:
+                        self.content.prefetch(path,
+                                              rule.template.content_fields)
+
+            window.append(item)
+            if len(window) > self.READ_AHEAD:
+                yield window.popleft()
+        yield from window
+
+    def candidates(self, path: str, rule_id_or_name: str=None) -> (str, str):
+        """
+        Iterate over (rule id, new path) for each rule applying on the path.
+        """
+        if path in self._folder_candidates:
+            # folders taken before were filtered out (like by shards): they
+            # will not come anymore
+            while True:
+                (taken, found) = self._folder_candidates.popitem(last=False)
+                if taken == path:
+                    return iter(found)
+        return ((rule.guid, new_path)
+                for (rule, new_path) in self.reformat(path, rule_id_or_name))
+
+    def takes_folder(self, path: str, rule_id_or_name: str=None) -> bool:
+        """
+        Tell if rules rename the folder itself, to rename it at once instead
+        of each file in it. Meant for `scan_fs(take_folder=...)`.
+        """
+        if not self.rules.for_folders():
+            return False
+        path += os.sep
+        found = list(self.candidates(path, rule_id_or_name))
+        if found:
+            # not matched again when the folder is renamed
+            self._folder_candidates[path] = found
+            if len(self._folder_candidates) > self.FOLDERS_TAKEN:
+                self._folder_candidates.popitem(last=False)
+        return bool(found)
+
+    def plan(self, paths: iter, rule_id_or_name: str=None) -> Step:
+        """
+        Yield the renames rules find for the paths, without doing them.
+        Steps for the same path follow each other, in the order to try them.
+        """
+        for path in self.read_ahead(paths, rule_id_or_name):
+            for (rule_id, new_path) in self.candidates(path, rule_id_or_name):
+                yield Step(path, new_path, rule_id)
+
+    def execute(self,
+                path: str,
+                candidates: ((str, str)),
+                action_mode: action.Flag,
+                confirm: callable=None) -> Result:
+        """
+        Try to rename the path with each (rule id, new path) candidate,
+        until it succeed.
+        If given, `confirm(path, new path)` answers ACCEPT, DISCARD,
+        SKIP_FILE or STOP_ACTION before each rename.
+        """
+        assert self._rename_file, "start_action must be called first"
+
+        for (rule_id, new_path) in candidates:
+            # paths are kept as strings while matching, up to here
+            new_path = Path(new_path)
+
+            if confirm:
+                choice = confirm(path, new_path)
+                if choice == self.DISCARD:
+                    continue
+                elif choice == self.SKIP_FILE:
+                    break
+                elif choice == self.STOP_ACTION:
+                    self.abort = True
+                    break
+
+            # actually rename (if not a simulation) the file
+            success = self._rename_file(Path(path), new_path,
+                                        rule_id, action_mode)
+            yield Result(path, str(new_path), rule_id, action_mode, success)
+
+            # stop trying to rename the file if it succeed and as it is for real
+            if action_mode.was_renamed and success:
+                break
+
+    def rename(self,
+               paths: iter,
+               rule_id_or_name: str=None,
+               simulation: bool=False,
+               confirm: callable=None) -> Result:
+        """
+        Rename the paths with the first rule succeeding, or only simulate
+        it.
+        """
+        self.abort = False
+        for path in self.read_ahead(paths, rule_id_or_name):
+            action_mode = action.Flag.from_(user_given_entry=False,
+                                            rule_is_manual=False,
+                                            simulation=simulation,
+                                            folder=path.endswith(os.sep))
+            yield from self.execute(path,
+                                    self.candidates(path, rule_id_or_name),
+                                    action_mode,
+                                    confirm)
+            if self.abort:
+                break
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
+import random
 import argparse
+import itertools
 from pathlib import Path
 
 import logger
@@ -9,75 +13,22 @@ import book
 import well
 import conf
 import action
+import profiling
+import progress
+import report
+import table
+from engine import Engine
 from utils import *
 
 
 EXIT_ERROR = 1
 
 
-class App:
-    """
-    Bundle of resources to of the application.
-    """
-
-    def __init__(self):
-        self.rules = None
-        self.rule_path = None
-        self.renamer = None
-        self.action_log = None
-
-    def phony_rules(self):
-        self.rules = book.Rules()
-
-    def load_rules(self, filepath: Path):
-        self.rule_path = filepath
-        self.rules = well.load_rules(filepath)
-
-    def save_rules(self):
-        if self.rule_path:
-            well.save_rules(self.rule_path, self.rules)
-        else:
-            logger.warn("no path of database to save rules")
-
-    def set_action_log(self, path: Path):
-        self.action_log = action.Log(path)
-
-    def open_action_log(self, actlog_path: Path):
-        self.set_action_log(actlog_path)
-        self.action_log.open_read()
-
-    def start_action(self, actlog_path: Path, silent: bool=False):
-        if silent:
-            self.rename = lambda *_: True
-            return
-
-        self.set_action_log(actlog_path)
-        self.action_log.open_write()
-        self.renamer = action.Renamer(self.action_log)
-        self.rename = self.renamer.rename
-
-    def end_action(self):
-        if not self.action_log:
-            return
-
-        self.rename = None
-        self.renamer = None
-        self.action_log.close_write()
-
-
 class Commands:
     """
     Common functions to all commands.
     """
 
-    def _reformat(self,
-                  rules: book.Rules,
-                  entry: Path,
-                  rule_id_or_name: str=None) -> int:
-        for (rule, entry, match) in rules.find_applying(entry, rule_id_or_name):
-            result = rule.format(entry, match)
-            yield (rule, result)
-
     def _add_rule(self, rules: book.Rules, args):
         """
         Add a rule from data in args.
@@ -87,9 +38,28 @@ class Commands:
             id_rule=args.id_rule,
             rename_rule=args.rename_rule,
             name=getattr(args, "name", None),
-            height=args.height)
+            height=args.height,
+            priority=getattr(args, "priority", 0),
+            suffixes=getattr(args, "suffixes", None),
+            folder=getattr(args, "folder", False))
         return rule
 
+    def _use_stats(self, app: Engine, args):
+        """
+        Set how rules statistics are used from data in args.
+        """
+        app.rules.use_adaptive_order(args.adaptive)
+        app.rules.record_stats = args.adaptive or args.record_stats
+        if args.rule_budget:
+            app.rules.budget = args.rule_budget / 1000
+
+    def _save_stats(self, app: Engine):
+        """
+        Save rules if their statistics or quarantine were updated.
+        """
+        if app.rules.record_stats or app.rules.dirty:
+            app.save_rules()
+
 
 class ConfigCommands(Commands):
     """
@@ -133,10 +103,64 @@ class RuleCommands(Commands):
         """
         logger.info("action: add a rule")
 
-        app = App()
+        # appended to the database: other rules are not loaded
+        rule = self._add_rule(book.Rules(), args)
+        well.append_rule(args.rule_db_path, rule)
+
+    def import_(self, args):
+        """
+        Add rules from a file in the database, all at once.
+        """
+        logger.info("action: import rules")
+
+        app = Engine()
         app.load_rules(args.rule_db_path)
-        self._add_rule(app.rules, args)
+
+        format_ = self._file_format(args)
+        try:
+            with self._open_text(args.path, "r") as input_:
+                (added, skipped) = well.import_rules(input_, app.rules,
+                                                     format_)
+        except FileNotFoundError:
+            print("No such file: {}".format(args.path))
+            return EXIT_ERROR
+        except ValueError as error:
+            print("Invalid rule at {}: nothing imported.".format(error))
+            return EXIT_ERROR
+
         app.save_rules()
+        print("Imported {} rule(s), {} already existing.".format(added,
+                                                                skipped))
+
+    def export(self, args):
+        """
+        Write rules from the database into a file.
+        """
+        logger.info("action: export rules")
+
+        app = Engine()
+        app.load_rules(args.rule_db_path)
+
+        with self._open_text(args.path, "w") as output:
+            well.export_rules(output, app.rules, self._file_format(args))
+
+    @staticmethod
+    def _file_format(args) -> str:
+        if args.format:
+            return args.format
+        return "csv" if args.path.lower().endswith(".csv") else "jsonl"
+
+    @staticmethod
+    def _open_text(path: str, mode: str):
+        """
+        Open a text file, or the standard input or output for '-'.
+        """
+        if path == "-":
+            stream = sys.stdin if mode == "r" else sys.stdout
+            # do not close the standard stream when done
+            return open(stream.fileno(), mode, closefd=False)
+        # csv handles the end of lines itself
+        return open(path, mode, newline="", encoding="utf8")
 
     def list(self, args):
         """
@@ -144,15 +168,106 @@ class RuleCommands(Commands):
         """
         logger.info("action: list rules")
 
-        app = App()
+        app = Engine()
         app.load_rules(args.rule_db_path)
+        app.rules.use_adaptive_order(args.adaptive)
 
-        for rule in app.rules:
+        # rules are listed in the order they are tried
+        for (order, rule) in enumerate(app.rules.ordered(), start=1):
             print("Rule", rule.guid,
                   ((" as " + rule.name) if rule.name else ""),
-                  ((" depth:" + str(rule.height)) if rule.height else ""))
+                  ((" depth:" + str(rule.height)) if rule.height else ""),
+                  ((" priority:" + str(rule.priority))
+                   if rule.priority else ""))
             print("  from '" + rule.identifier_as_text + "'")
             print("    to '" + rule.renamer_as_text + "'")
+            if rule.folder:
+                print("  on folders")
+            elif rule.suffixes is not None:
+                print("  only on " + " ".join(sorted(rule.suffixes)))
+            print("  order {}, {} hit(s) on {} tries, {:.0f} ns/match".format(
+                order, rule.hits, rule.tries, rule.match_cost))
+
+        for rule in app.rules.quarantined():
+            print("Rule", rule.guid,
+                  ((" as " + rule.name) if rule.name else ""),
+                  " quarantined")
+            print("  from '" + rule.identifier_as_text + "'")
+            print("    to '" + rule.renamer_as_text + "'")
+
+    def profile(self, args):
+        """
+        Measure the cost of rules over a corpus of paths.
+        """
+        logger.info("action: profile rules")
+
+        app = Engine()
+        app.load_rules(args.rule_db_path)
+
+        corpus_path = Path(args.corpus)
+        if corpus_path.is_dir():
+            corpus = scan_fs((str(corpus_path),), recursive=True)
+        elif corpus_path.is_file():
+            with open(str(corpus_path), "r") as input_:
+                corpus = [line.rstrip("\n") for line in input_]
+        else:
+            print("No such corpus: {}".format(corpus_path))
+            return EXIT_ERROR
+        corpus = list(itertools.islice(corpus, args.limit))
+
+        rules = app.rules
+        if args.rule_lkup:
+            rules = filter(lambda r: args.rule_lkup in (r.name, r.guid),
+                           rules)
+
+        for cost in profiling.profile(rules, corpus,
+                                      adversarial=not args.quick):
+            rule = cost.rule
+            print("{}Rule".format("!" if cost.flagged else ""), rule.guid,
+                  ((" as " + rule.name) if rule.name else ""))
+            print("  {:.0f} ns/match, {} hit(s) on {} paths".format(
+                cost.ns_per_match, cost.hits, cost.tries))
+            if not args.quick:
+                print("  growth: " + cost.verdict())
+
+    def release(self, args):
+        """
+        Take rules out of quarantine.
+        """
+        logger.info("action: release rule(s)")
+
+        app = Engine()
+        app.load_rules(args.rule_db_path)
+
+        success = True
+        for rule_lkup in args.rules_lkup:
+            rule = app.rules.find(rule_lkup)
+            if rule is None:
+                print("No such rule: {}".format(rule_lkup))
+                success = False
+            else:
+                app.rules.quarantine(rule, enabled=False)
+        app.save_rules()
+
+        if not success:
+            return EXIT_ERROR
+
+    def priority(self, args):
+        """
+        Change the priority of a rule in the database.
+        """
+        logger.info("action: set rule priority")
+
+        app = Engine()
+        app.load_rules(args.rule_db_path)
+
+        rule = app.rules.find(args.rules_lkup[0])
+        if rule is None:
+            print("No such rule: {}".format(args.rules_lkup[0]))
+            return EXIT_ERROR
+
+        app.rules.set_priority(rule, args.priority)
+        app.save_rules()
 
     def remove(self, args):
         """
@@ -160,7 +275,7 @@ class RuleCommands(Commands):
         """
         logger.info("action: remove rule(s)")
 
-        app = App()
+        app = Engine()
         app.load_rules(args.rule_db_path)
 
         success = True
@@ -179,7 +294,11 @@ class FileCommands(Commands):
 
     def __init__(self, config: conf.Conf):
         self.config = config
-        self.app = App()
+        self.app = Engine()
+        self.report = None
+        self.progress = progress.Progress(enabled=False)
+        # entries seen while sampling them
+        self.scanned = 0
 
     def test(self, args):
         """
@@ -188,30 +307,25 @@ class FileCommands(Commands):
         logger.info("action: test")
 
         self.app.load_rules(args.rule_db_path)
+        self._use_stats(self.app, args)
+        self.app.use_content(self.config.hash_cache_path)
         self.app.start_action(self.config.actlog_path,
-                              silent=args.silent_act_log)
-
-        for entry in (Path(p) for p in args.entries):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=True,
-                        rule_is_manual=False,
-                        simulation=True)
-
-        dir_paths = (Path(p) for p in args.dir_paths)
-        for entry in scan_fs(dir_paths, recursive=False):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=False,
-                        rule_is_manual=False,
-                        simulation=True)
-
-        recur_paths = (Path(p) for p in args.recur_paths)
-        for entry in scan_fs(recur_paths, recursive=True):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=False,
+                              silent=args.silent_act_log,
+                              summary_examples=self._summary_examples(args))
+        self.report = report.make_report(args.output)
+        self._start_progress(args)
+
+        entries = self._sampled_entries(args)
+        self._apply_all(args, args.rule_lkup,
+                        entries=entries,
                         rule_is_manual=False,
                         simulation=True)
 
+        self.report.close()
+        self.progress.close()
         self.app.end_action()
+        self._save_stats(self.app)
+        self._print_match_rate(args)
 
     def manual_test(self, args):
         """
@@ -221,30 +335,23 @@ class FileCommands(Commands):
 
         self.app.phony_rules()
         rule = self._add_rule(self.app.rules, args)
+        self.app.use_content(self.config.hash_cache_path)
         self.app.start_action(self.config.actlog_path,
-                              silent=args.silent_act_log)
-
-        for entry in (Path(p) for p in args.entries):
-            self._apply(entry, rule.guid,
-                        user_given_entry=True,
-                        rule_is_manual=True,
-                        simulation=True)
-
-        dir_paths = (Path(p) for p in args.dir_paths)
-        for entry in scan_fs(dir_paths, recursive=False):
-            self._apply(entry, rule.guid,
-                        user_given_entry=False,
-                        rule_is_manual=True,
-                        simulation=True)
-
-        recur_paths = (Path(p) for p in args.recur_paths)
-        for entry in scan_fs(recur_paths, recursive=True):
-            self._apply(entry, rule.guid,
-                        user_given_entry=False,
+                              silent=args.silent_act_log,
+                              summary_examples=self._summary_examples(args))
+        self.report = report.make_report(args.output)
+        self._start_progress(args)
+
+        entries = self._sampled_entries(args)
+        self._apply_all(args, rule.guid,
+                        entries=entries,
                         rule_is_manual=True,
                         simulation=True)
 
+        self.report.close()
+        self.progress.close()
         self.app.end_action()
+        self._print_match_rate(args)
 
     def rename(self, args):
         """
@@ -252,86 +359,426 @@ class FileCommands(Commands):
         """
         logger.info("action: execution")
 
+        if args.resume:
+            return self._resume(args)
+
         self.app.load_rules(args.rule_db_path)
-        self.app.start_action(self.config.actlog_path, silent=False)
+        self._use_stats(self.app, args)
+        self.app.use_content(self.config.hash_cache_path)
+        self.app.start_action(self.config.actlog_path, silent=False,
+                              throttle=self._throttle(args, "rename"))
+        self._start_cursor("rename", args)
+        self.report = report.make_report(args.output)
+        self._start_progress(args)
 
         # TODO add cmd switch to prevent folder creation
         # TODO add cmd switch to prune empty folder after rename
 
-        self.abort = False
-
-        for entry in (Path(p) for p in args.entries):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=True,
+        # scans are sorted, to be able to resume them
+        self._apply_all(args, args.rule_lkup,
+                        entries=self._sharded_entries(args, sort=True),
                         rule_is_manual=False,
                         simulation=False,
                         confirmation=args.ask_to_confirm)
-            if self.abort:
-                break
 
-        dir_paths = (Path(p) for p in args.dir_paths)
-        for entry in scan_fs(dir_paths, recursive=False):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=False,
-                        rule_is_manual=False,
-                        simulation=False,
-                        confirmation=args.ask_to_confirm)
-            if self.abort:
-                break
+        self._end_cursor()
 
-        recur_paths = (Path(p) for p in args.recur_paths)
-        for entry in scan_fs(recur_paths, recursive=True):
-            self._apply(entry, args.rule_lkup,
-                        user_given_entry=False,
-                        rule_is_manual=False,
-                        simulation=False,
-                        confirmation=args.ask_to_confirm)
-            if self.abort:
+    def plan(self, args):
+        """
+        Find rules applying and save the renames to do into a plan.
+        """
+        logger.info("action: plan")
+
+        self.app.load_rules(args.rule_db_path)
+        self._use_stats(self.app, args)
+        self.app.use_content(self.config.hash_cache_path)
+
+        plan = action.Plan(Path(args.plan_path))
+        plan.open_write()
+        self._start_progress(args)
+
+        count_entries = 0
+        count_steps = 0
+        entries = (entry for (entry, _)
+                   in self.progress.count_files(self._sharded_entries(args)))
+        last = None
+        for step in self.app.plan(entries, args.rule_lkup):
+            plan.write(*step)
+            count_steps += 1
+            # steps of a file follow each other
+            count_entries += step.source != last
+            last = step.source
+            self.progress.matched = count_entries
+
+        plan.close_write()
+        self.progress.close()
+        self.app.end_action()
+        self._save_stats(self.app)
+        print("Plan of {} rename(s) for {} file(s) saved to {}".format(
+            count_steps, count_entries, plan.path))
+
+    def apply(self, args):
+        """
+        Rename files from a plan.
+        """
+        logger.info("action: apply plan")
+
+        plan = action.Plan(Path(args.plan_path))
+        if not plan.path.is_file():
+            print("No such plan: {}".format(plan.path))
+            return EXIT_ERROR
+
+        # rules are only needed to show their names
+        self.app.load_rules(args.rule_db_path)
+        self.app.start_action(self.config.actlog_path, silent=False,
+                              throttle=self._throttle(args, "rename"))
+        self._start_cursor("apply", args)
+        self.report = report.make_report(args.output)
+        self._start_progress(args)
+
+        self._apply_plan(plan, args)
+
+        self._end_cursor()
+
+    def _apply_plan(self,
+                    plan: action.Plan,
+                    args,
+                    start_after: str=None,
+                    again: bool=False):
+        """
+        Rename files from the plan.
+        If `start_after` is given, start from the file after it, or from it
+        if `again` is true.
+        """
+        self.app.abort = False
+
+        steps = plan.read_iter()
+        if args.shard:
+            index, count = args.shard
+            steps = (step for step in steps
+                     if shard_of(step[0], count) == index)
+
+        # all steps of a file are tried in a row, until one succeed
+        files = itertools.groupby(steps, lambda s: s[0])
+        if start_after is not None:
+            files = itertools.dropwhile(lambda f: f[0] != start_after, files)
+            if not again:
+                next(files, None)
+        files = self.progress.count_files(files)
+        self.progress.fraction = plan.read_fraction
+
+        for (entry, file_steps) in files:
+            candidates = ((guid, new_entry)
+                          for (_, new_entry, guid) in file_steps)
+            self._execute(entry, candidates,
+                          user_given_entry=False,
+                          rule_is_manual=False,
+                          simulation=False,
+                          confirmation=args.ask_to_confirm)
+            if self.app.abort:
                 break
 
+    def _start_cursor(self, command: str, args):
+        """
+        Save what is needed to resume the command if it stops before its end.
+        """
+        segment = self.app.action_log.write_path
+        self.cursor = action.Cursor(segment)
+        if self.cursor.load() is not None:
+            logger.warn("previous interrupted run cannot be resumed anymore")
+        self.cursor.save(command, vars(args), segment.stat().st_size)
+
+    def _end_cursor(self):
+        self.report.close()
+        self.progress.close()
         self.app.end_action()
+        self._save_stats(self.app)
+        self.cursor.clear()
 
-    def _status(self,
-                success: bool,
-                action_mode: action.Flag):
-        status = ""
-        if not success:
-            status = "!"
+    def _resume(self, resume_args):
+        """
+        Resume the last rename or apply stopped before its end.
+        """
+        logger.info("action: resume")
+
+        # runs still going on hold the segment of the log they write into
+        log = action.Log(self.config.actlog_path)
+        for segment in log.segments():
+            cursor = action.Cursor(segment)
+            state = cursor.load()
+            if state is not None and log.open_write(segment):
+                break
+        else:
+            print("Nothing to resume.")
+            return EXIT_ERROR
+        args = argparse.Namespace(**state["args"])
+        if resume_args.max_ops is not None:
+            args.max_ops = resume_args.max_ops
+            args.backoff = resume_args.backoff
+
+        # the log tells the last rename done, and files created since the
+        # start, not to rename them again
+        last = None
+        created = action.Created()
+        for line in log.read_iter_from(segment, state["log_offset"]):
+            if isinstance(line, action.LogLine) and line.mode.was_renamed:
+                last = line
+                if line.mode.entry_was_found:
+                    created.passed(line.source)
+                if line.success is True:
+                    created.add(line.dest)
+        # cut the action being written when it stopped
+        log.truncate(log.end_offset)
+
+        self.app.load_rules(args.rule_db_path)
+        # a plan already holds the rule of each file: nothing is matched
+        if state["command"] != "apply":
+            self._use_stats(self.app, args)
+            self.app.use_content(self.config.hash_cache_path)
+        self.app.start_action(self.config.actlog_path, silent=False, log=log,
+                              throttle=self._throttle(args, "rename"))
+        self.cursor = cursor
+        self.report = report.make_report(resume_args.output)
+        self._start_progress(resume_args)
+
+        position = None
+        again = False
+        if last is not None:
+            position = self._logged_entry(last.source, last.mode)
+            if last.success is None:
+                again = self._check_in_flight(last)
+                if not again:
+                    created.add(last.dest)
+            logger.info("resume after {}".format(position))
+
+        if state["command"] == "apply":
+            self._apply_plan(action.Plan(Path(args.plan_path)), args,
+                             start_after=position,
+                             again=again)
         else:
-            status = ("S"
-                      if action_mode.is_simulated
-                      else "#")
+            # the scan goes on after the folder, not into it
+            entries = self._sharded_entries(
+                args,
+                sort=True,
+                start_after=position and position.rstrip(os.sep))
+            entries = ((entry, user_given)
+                       for (entry, user_given) in entries
+                       if not created.pop(entry))
+            if again:
+                entries = itertools.chain(
+                    [(position, last.mode.entry_was_given_manually)],
+                    entries)
+            self._apply_all(args, args.rule_lkup,
+                            entries=entries,
+                            rule_is_manual=False,
+                            simulation=False,
+                            confirmation=args.ask_to_confirm)
+
+        self._end_cursor()
+
+    @staticmethod
+    def _logged_entry(path: str, mode: action.Flag) -> str:
+        """
+        Entry of a path from the log: folders end with a separator, like
+        when they are scanned or planned.
+        """
+        return path + os.sep if mode.is_folder else path
 
-        status += ("m"
-                   if action_mode.rule_is_manual
-                   else "r")
-        status += ("s"
-                   if action_mode.entry_was_found
-                   else "i")
+    def _check_in_flight(self, line: action.LogLine) -> bool:
+        """
+        Find if the action being done when it stopped was done, the last
+        one of the log. Return True if it must be done again: it is then cut
+        from the log, not to be there twice.
+        """
+        source, dest = Path(line.source), Path(line.dest)
+        if source.exists():
+            self.app.renamer.log.truncate(line.offset)
+            return True
+
+        if dest.exists():
+            # only its result is missing from the log
+            self.app.renamer.record_result(True)
+            self.report.rename(True, line.mode, line.rule_id,
+                               self._rule_prefix(line.rule_id),
+                               source, dest)
+        else:
+            logger.warn("File not found: {}".format(source))
+        return False
 
-        return status
+    def _rule_prefix(self, guid: str) -> str:
+        rule = self.app.rules.rules.get(guid, None)
+        return rule.name_prefix() if rule else guid
 
-    ACCEPT      = 1
-    DISCARD     = 2
-    SKIP_FILE   = 3
-    STOP_ACTION = 4
+    def _summary_examples(self, args) -> int:
+        """
+        Number of examples kept in the summary of a simulation, or None to
+        log every simulated rename.
+        """
+        sim_log = args.sim_log or self.config.simulation_log
+        if sim_log == "summary":
+            return args.examples
+        return None
+
+    def _roots(self, args) -> [(str, str)]:
+        """
+        Where entries come from, in order, as (kind, path): kind is 'entry'
+        for manual entries, 'scan' or 'recursive' for folders.
+        """
+        # manual entries ending with a separator are folders to rename
+        return ([("entry", str(Path(p)) + (os.sep if p.endswith(os.sep)
+                                            and p != os.sep else ""))
+                 for p in args.entries]
+                + [("scan", str(Path(p))) for p in args.dir_paths]
+                + [("recursive", str(Path(p))) for p in args.recur_paths])
+
+    @staticmethod
+    def _comes_from(entry: str, kind: str, root: str) -> bool:
+        if kind == "entry":
+            return entry == root
+        elif kind == "scan":
+            return (os.path.dirname(entry) or os.curdir) == root
+        elif root == os.curdir:
+            return not os.path.isabs(entry)
+        return entry.startswith(root.rstrip(os.sep) + os.sep)
+
+    def _entries(self,
+                 args,
+                 sort: bool=False,
+                 start_after: str=None) -> (str, bool):
+        """
+        Yield entries from the command line, then the ones scanned.
+        Each entry is a path as string, with a flag telling if it was given
+        manually.
+        With sorted scans, it can start after an entry yielded before.
+        """
+        exclude = name_matcher(self.config.exclude + tuple(args.exclude))
+        rule_lkup = getattr(args, "rule_lkup", None)
+        take_folder = lambda path: self.app.takes_folder(path, rule_lkup)
+
+        throttle = self._throttle(args, "scan")
+
+        roots = self._roots(args)
+        first = 0
+        if start_after is not None:
+            first = first_that(
+                lambda i: self._comes_from(start_after, *roots[i]),
+                range(len(roots)))
+            if first is None:
+                logger.warn("cannot find where {} comes from, start from"
+                            " the beginning".format(start_after))
+                first, start_after = 0, None
+
+        for (index, (kind, root)) in enumerate(roots[first:], start=first):
+            after = start_after if index == first else None
+            if kind == "entry":
+                if after is None:
+                    yield (root, True)
+                continue
+
+            for entry in scan_fs((root,),
+                                 max_depth=args.max_depth,
+                                 recursive=(kind == "recursive"),
+                                 exclude=exclude,
+                                 sort=sort,
+                                 start_after=after,
+                                 take_folder=take_folder,
+                                 follow_symlinks=args.follow_symlinks,
+                                 one_file_system=args.one_file_system,
+                                 unique_inodes=args.unique_inodes,
+                                 on_folder=self.progress.folder,
+                                 throttle=throttle):
+                yield (entry, False)
+
+    @staticmethod
+    def _throttle(args, kind: str) -> RateLimiter:
+        """
+        Rate limiter of the file system calls to scan or rename, if asked.
+        """
+        rates = getattr(args, "max_ops", None)
+        if rates is None:
+            return None
+        return RateLimiter(rates[kind], adaptive=args.backoff)
+
+    def _sharded_entries(self, args, **kw) -> (str, bool):
+        """
+        Same as `_entries`, but only those from the shard given in args.
+        """
+        if not args.shard:
+            return self._entries(args, **kw)
+
+        index, count = args.shard
+        return ((entry, user_given)
+                for (entry, user_given) in self._entries(args, **kw)
+                if shard_of(entry, count) == index)
+
+    def _sampled_entries(self, args) -> (str, bool):
+        """
+        Same as `_sharded_entries`, but stopping after the max number of
+        files, and only a uniform sample of them if asked for.
+        A uniform sample needs every entry, so the whole tree is read unless
+        the max number of files is given.
+        """
+        entries = self._sharded_entries(args)
+        if args.max_files is not None:
+            entries = itertools.islice(entries, args.max_files)
+        if args.sample is None:
+            return entries
+        if args.max_files is None:
+            logger.warn("the sample is drawn from every entry of the tree,"
+                        " use --max-files to stop earlier")
+
+        (sample, self.scanned) = reservoir_sample(entries, args.sample,
+                                                  random.Random(args.seed))
+        logger.info("sampled {} of {} entries".format(len(sample),
+                                                      self.scanned))
+        return sample
+
+    def _start_progress(self, args):
+        """
+        Show the progress on stderr, unless disabled or renames are
+        confirmed one by one.
+        """
+        self.progress = progress.Progress(
+            enabled=not (args.no_progress
+                         or getattr(args, "ask_to_confirm", False)))
+        self.progress.sampled = getattr(args, "sample", None) is not None
+        if self.report:
+            self.report.progress = self.progress
+
+    def _print_match_rate(self, args):
+        """
+        Print, on stderr to keep reports clean, the rate of sampled entries
+        rules apply on.
+        """
+        if args.sample is None:
+            return
+        total = min(args.sample, self.scanned)
+        matched = self.progress.matched
+        (low, high) = wilson_interval(matched, total)
+        print("{} of {} sampled entries matched ({:.1%}, 95% confidence"
+              " interval {:.1%} - {:.1%}), among {} scanned".format(
+                  matched, total, matched / total if total else 0,
+                  low, high, self.scanned),
+              file=sys.stderr)
 
     def _confirm(self, entry: Path, new_entry: Path):
         msg = "rename: '{}' --> '{}'  [y]es/[n]o/[s]kip/[q]uit ? ".format(entry, new_entry)
         answers = {
             # accept
-            "y": self.ACCEPT,
-            "Y": self.ACCEPT,
+            "y": Engine.ACCEPT,
+            "Y": Engine.ACCEPT,
             # cancel
-            "n": self.DISCARD,
-            "N": self.DISCARD,
+            "n": Engine.DISCARD,
+            "N": Engine.DISCARD,
             # skip file
-            "s": self.SKIP_FILE,
-            "S": self.SKIP_FILE,
+            "s": Engine.SKIP_FILE,
+            "S": Engine.SKIP_FILE,
             # quit
-            "q": self.STOP_ACTION,
-            "Q": self.STOP_ACTION
+            "q": Engine.STOP_ACTION,
+            "Q": Engine.STOP_ACTION
         }
+        # renames reported so far are shown before the question
+        self.report.flush()
         res = input(msg)
         while res not in answers:
             print("Invalid answer.")
@@ -339,36 +786,64 @@ class FileCommands(Commands):
 
         return answers[res]
 
-    def _apply(self,
-               entry: Path,
-               rule_id_or_name: str,
-               confirmation: bool=False,
-               **kw):
-        action_mode = action.Flag.from_(**kw)
-
-        for (rule, new_entry) in self._reformat(self.app.rules, entry, rule_id_or_name):
-
-            if confirmation:
-                choice = self._confirm(entry, new_entry)
-                if choice == self.DISCARD:
-                    continue
-                elif choice == self.SKIP_FILE:
-                    break
-                elif choice == self.STOP_ACTION:
-                    self.abort = True
-                    break
+    def _apply_all(self,
+                   args,
+                   rule_id_or_name: str,
+                   entries: iter=None,
+                   confirmation: bool=False,
+                   **kw):
+        """
+        Apply rules on all entries (from args if not given), one after the
+        other or through a pipeline.
+        """
+        if entries is None:
+            entries = self._sharded_entries(args)
+        entries = self.progress.count_files(entries)
+        entries = self.app.read_ahead(entries, rule_id_or_name,
+                                      key=lambda entry: entry[0])
+
+        if args.pipeline:
+            # needs Python >= 3.5, so only imported when asked for
+            import pipeline
+            pipeline.run(
+                entries,
+                lambda entry: self.app.candidates(entry, rule_id_or_name),
+                lambda entry, candidates, user_given: self._execute(
+                    entry, candidates, user_given_entry=user_given, **kw))
+            return
 
-            # actually rename (if not a simulation) the file
-            success = self.app.rename(entry, new_entry, rule.guid, action_mode)
+        self.app.abort = False
+        for (entry, user_given) in entries:
+            self._execute(entry,
+                          self.app.candidates(entry, rule_id_or_name),
+                          user_given_entry=user_given,
+                          confirmation=confirmation,
+                          **kw)
+            if self.app.abort:
+                break
 
+    def _execute(self,
+                 entry: str,
+                 candidates: ((str, str)),
+                 confirmation: bool=False,
+                 **kw):
+        """
+        Try to rename the entry with each (rule id, new entry) candidate,
+        until it succeed, and report it.
+        """
+        action_mode = action.Flag.from_(folder=entry.endswith(os.sep), **kw)
+        confirm = self._confirm if confirmation else None
+
+        found = False
+        for result in self.app.execute(entry, candidates, action_mode,
+                                       confirm):
+            found = True
+            self.progress.result(result.success, result.mode.is_simulated)
             # log to the user what has been done
-            print("{}:{}: '{}' --> '{}'".format(
-                self._status(success, action_mode),
-                rule.name_prefix(), entry, new_entry))
-
-            # stop trying to rename the file if it succeed and as it is for real
-            if action_mode.was_renamed and success:
-                break
+            self.report.rename(result.success, result.mode, result.rule_id,
+                               self._rule_prefix(result.rule_id),
+                               result.source, result.dest)
+        self.progress.matched += found
 
     def log(self, args):
         """
@@ -377,13 +852,46 @@ class FileCommands(Commands):
         logger.info("action: log")
 
         self.app.open_action_log(self.config.actlog_path)
+        if args.stats:
+            return self._log_stats(args)
+        self.report = report.make_report(args.output)
 
         # TODO add cmd switch to print relative path from cwd
 
-        # TODO add format input from cmd
         for line in self.app.action_log.read_iter():
-            s = self._status(line.success, line.mode)
-            print("{}: '{}' --> '{}'".format(s, line.source, line.dest))
+            if isinstance(line, action.SummaryLine):
+                self.report.summary(line)
+                continue
+            self.report.rename(line.success, line.mode, line.rule_id, None,
+                               line.source, line.dest)
+        self.report.close()
+        self.app.action_log.close_read()
+
+    def _log_stats(self, args):
+        """
+        Print the number of actions by status for each group.
+        """
+        rows = table.LogTable.load(self.app.action_log).stats(args.group_by)
+        self.app.action_log.close_read()
+
+        if args.output == "jsonl":
+            for row in rows:
+                print(json.dumps(row._asdict()))
+            return
+        elif args.output == "tsv":
+            print("\t".join(table.Stats._fields))
+            for row in rows:
+                print("\t".join(str(field) for field in row))
+            return
+
+        width = max([len(args.group_by)] + [len(row.group) for row in rows])
+        print("{:{}}  {:>9}  {:>9}  {:>9}  {:>9}  {:>9}  {:>7}".format(
+            args.group_by, width, "total", "renamed", "simulated", "failed",
+            "unknown", "failure"))
+        for row in rows:
+            print("{:{}}  {:9}  {:9}  {:9}  {:9}  {:9}  {:7.1%}".format(
+                row.group, width, row.total, row.renamed, row.simulated,
+                row.failed, row.unknown, row.failed / row.total))
 
     def clear_log(self, args):
         """
@@ -421,6 +929,8 @@ class Args:
             help="Mode to use")
         self.install_init(subparser)
         self.install_action(subparser)
+        self.install_plan(subparser)
+        self.install_apply(subparser)
         self.install_log(subparser)
         self.install_test(subparser)
         self.install_manual_test(subparser)
@@ -428,7 +938,10 @@ class Args:
 
         # identify what action to do and execute it
         args = parser.parse_args()
-        self.load_conf(args)
+        try:
+            self.load_conf(args)
+        except ValueError as error:
+            parser.error(str(error))
         self.find_rule_db_path(args)
         self.resolve(args,
                      parser.print_help,
@@ -479,12 +992,19 @@ class Args:
                 True: fc.clear_log
             },
             "rename": fc.rename,
+            "plan": fc.plan,
+            "apply": fc.apply,
             "manual-test": fc.manual_test,
             "rules": {
                 "_key": "action",
                 "_help": rule_help,
                 "add": rc.add,
+                "export": rc.export,
+                "import": rc.import_,
                 "list": rc.list,
+                "priority": rc.priority,
+                "profile": rc.profile,
+                "release": rc.release,
                 "remove": rc.remove
             },
         }
@@ -542,6 +1062,180 @@ class Args:
             dest="silent_act_log",
             action="store_true")
 
+    def _insert_sim_log(self, parser):
+        parser.add_argument(
+            "--sim-log",
+            help=("log every simulated rename ('full'), or only a summary of"
+                  " the run ('summary'); default is from the configuration"
+                  " file, or 'full'"),
+            dest="sim_log",
+            choices=conf.SIMULATION_LOGS)
+        parser.add_argument(
+            "--examples",
+            help="number of renames sampled into the summary (default 10)",
+            type=int,
+            default=10,
+            metavar="n")
+
+    def _insert_folder(self, parser):
+        return parser.add_argument(
+            "--folder",
+            help=("the rule renames folders at once, instead of the files in"
+                  " them (give folders to test with a trailing '/')"),
+            action="store_true")
+
+    def _insert_output(self, parser):
+        return parser.add_argument(
+            "--output",
+            help=("how renames are reported: 'text' (default), 'jsonl' (one"
+                  " object per rename), 'tsv' (status, rule id, source,"
+                  " destination, count), 'quiet' or 'summary' (counts by"
+                  " status and rule)"),
+            choices=report.FORMATS,
+            default="text")
+
+    def _insert_sampling(self, parser):
+        parser.add_argument(
+            "--max-files",
+            help="stop after this number of entries",
+            metavar="M",
+            type=int)
+        parser.add_argument(
+            "--sample",
+            help=("only test a uniform sample of this number of entries, and"
+                  " give the rate of those matched (every entry is read to"
+                  " draw it: add --max-files to stop earlier on huge trees)"),
+            metavar="N",
+            type=int)
+        parser.add_argument(
+            "--seed",
+            help="seed of the sample, to draw the same one again",
+            type=int)
+
+    def _insert_progress(self, parser):
+        return parser.add_argument(
+            "--no-progress",
+            help=("do not show the progress on stderr (only shown on a"
+                  " terminal)"),
+            action="store_true")
+
+    def _insert_shard(self, parser):
+        return parser.add_argument(
+            "--shard",
+            help=("only work on the i-th part (from 1 to N) of the entries,"
+                  " split by a stable hash of their path"),
+            metavar="i/N",
+            type=self._shard_type,
+            default=None)
+
+    @staticmethod
+    def _shard_type(text: str) -> (int, int):
+        """
+        Parse 'i/N' into (i-1, N).
+        """
+        try:
+            index, count = (int(x) for x in text.split("/"))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "invalid shard '{}', expected i/N".format(text))
+        if not 1 <= index <= count:
+            raise argparse.ArgumentTypeError(
+                "invalid shard '{}', expected 1 <= i <= N".format(text))
+        return (index - 1, count)
+
+    def _insert_throttle(self, parser):
+        parser.add_argument(
+            "--max-ops-per-sec",
+            help=("at most N file system calls per second while scanning,"
+                  " and M while renaming (N if not given)"),
+            metavar="N[/M]",
+            dest="max_ops",
+            type=self._rate_type)
+        parser.add_argument(
+            "--backoff",
+            help=("with --max-ops-per-sec, slow down while file system calls"
+                  " get slower than usual"),
+            action="store_true")
+
+    @staticmethod
+    def _rate_type(text: str) -> dict:
+        """
+        Parse 'N' or 'N/M' into rates to scan and to rename.
+        """
+        try:
+            rates = [float(x) for x in text.split("/")]
+        except ValueError:
+            rates = []
+        if not 1 <= len(rates) <= 2 or min(rates) <= 0:
+            raise argparse.ArgumentTypeError(
+                "invalid rate '{}', expected N or N/M".format(text))
+        return {"scan": rates[0], "rename": rates[-1]}
+
+    def _insert_pipeline(self, parser):
+        return parser.add_argument(
+            "--pipeline",
+            help=("scan, match and rename at the same time"
+                  " (requires Python >= 3.5)"),
+            action="store_true")
+
+    def _insert_stats(self, parser):
+        parser.add_argument(
+            "--adaptive",
+            help=("try rules with the best hit rate for their cost first,"
+                  " after their priority (implies --record-stats)"),
+            action="store_true")
+        parser.add_argument(
+            "--record-stats",
+            help="save hits and cost of rules into the database",
+            dest="record_stats",
+            action="store_true")
+        parser.add_argument(
+            "--rule-budget",
+            help=("put in quarantine rules whose match takes more than"
+                  " this time, in milliseconds, a few times in a run"),
+            dest="rule_budget",
+            type=float,
+            metavar="ms")
+
+    def _insert_scan_options(self, parser):
+        parser.add_argument(
+            "--max-depth",
+            help=("maximum number of folders entered below recursive paths"
+                  " (default is no limit)"),
+            dest="max_depth",
+            type=int,
+            default=-1,
+            metavar="n")
+        parser.add_argument(
+            "--exclude",
+            help=("do not enter folders with this name, as a glob or as a"
+                  " regular expression prefixed by 're:' (repeatable)"),
+            metavar="pattern",
+            action="append",
+            default=[])
+        parser.add_argument(
+            "--follow-symlinks",
+            help=("enter symbolic links to folders, each folder once"
+                  " (default)"),
+            dest="follow_symlinks",
+            action="store_true",
+            default=True)
+        parser.add_argument(
+            "--no-follow-symlinks",
+            help="do not enter symbolic links to folders",
+            dest="follow_symlinks",
+            action="store_false")
+        parser.add_argument(
+            "--one-file-system",
+            help="do not enter folders on other file systems",
+            dest="one_file_system",
+            action="store_true")
+        parser.add_argument(
+            "--unique-inodes",
+            help="only take one of the hard links to the same file",
+            dest="unique_inodes",
+            action="store_true")
+
     def _collapse_arg(self, args, prefix: str):
         """
         Find in args the first "<prefix><number>" and save into <prefix> the
@@ -580,9 +1274,20 @@ class Args:
         self._add_conf_argument(parser, depth=2)
         self._add_db_argument(parser, depth=1)
         self._insert_rule_lookup(parser)
-        parser.add_argument("-i", "--interactive",
-                            help="prompt before every action",
-                            dest="ask_to_confirm",
+        self._insert_shard(parser)
+        self._insert_stats(parser)
+        exclusive = parser.add_mutually_exclusive_group()
+        exclusive.add_argument("-i", "--interactive",
+                               help="prompt before every action",
+                               dest="ask_to_confirm",
+                               action="store_true")
+        self._insert_pipeline(exclusive)
+        self._insert_output(parser)
+        self._insert_progress(parser)
+        self._insert_throttle(parser)
+        parser.add_argument("--resume",
+                            help=("resume the last rename or apply stopped"
+                                  " before its end, with its arguments"),
                             action="store_true")
         parser.add_argument("entries",
                             help="manual entries to rename",
@@ -601,6 +1306,67 @@ class Args:
                             action="append",
                             dest="recur_paths",
                             default=[])
+        self._insert_scan_options(parser)
+        return parser
+
+    def install_plan(self, subparser):
+        parser = subparser.add_parser(
+            "plan",
+            help="Save renames to do into a plan.",
+            description=("Find registered rules applying, and save the"
+                         " renames to do into a plan file, to apply later.")
+        )
+        self._add_conf_argument(parser, depth=2)
+        self._add_db_argument(parser, depth=1)
+        self._insert_rule_lookup(parser)
+        self._insert_shard(parser)
+        self._insert_progress(parser)
+        self._insert_throttle(parser)
+        self._insert_stats(parser)
+        parser.add_argument("-o", "--out",
+                            help="plan file to write",
+                            metavar="path",
+                            dest="plan_path",
+                            required=True)
+        parser.add_argument("entries",
+                            help="manual entries to plan",
+                            metavar="text",
+                            nargs="*",
+                            default=[])
+        parser.add_argument("-s", "--scan",
+                            help="plan on files from given path, not recursive",
+                            metavar="path",
+                            action="append",
+                            dest="dir_paths",
+                            default=[])
+        parser.add_argument("-r", "--recursive",
+                            help="plan on files from given path, recursive",
+                            metavar="path",
+                            action="append",
+                            dest="recur_paths",
+                            default=[])
+        self._insert_scan_options(parser)
+        return parser
+
+    def install_apply(self, subparser):
+        parser = subparser.add_parser(
+            "apply",
+            help="Rename files from a plan.",
+            description="Rename files from a plan made by 'plan'."
+        )
+        self._add_conf_argument(parser, depth=2)
+        self._add_db_argument(parser, depth=1)
+        self._insert_shard(parser)
+        parser.add_argument("-i", "--interactive",
+                            help="prompt before every action",
+                            dest="ask_to_confirm",
+                            action="store_true")
+        self._insert_output(parser)
+        self._insert_progress(parser)
+        self._insert_throttle(parser)
+        parser.add_argument("plan_path",
+                            help="plan file to apply",
+                            metavar="plan")
         return parser
 
     def install_log(self, subparser):
@@ -613,6 +1379,15 @@ class Args:
         parser.add_argument("--clear",
                             help="Wipe out the log.",
                             action="store_true")
+        self._insert_output(parser)
+        parser.add_argument("--stats",
+                            help=("print the number of actions by status for"
+                                  " each group, instead of the actions"),
+                            action="store_true")
+        parser.add_argument("--group-by",
+                            help="groups of --stats (default is rule)",
+                            choices=table.GROUP_BY,
+                            default="rule")
         return parser
 
     def install_test(self, subparser):
@@ -625,6 +1400,14 @@ class Args:
         self._add_db_argument(parser, depth=1)
         self._insert_rule_lookup(parser)
         self._insert_silent_action_log(parser)
+        self._insert_sim_log(parser)
+        self._insert_output(parser)
+        self._insert_progress(parser)
+        self._insert_throttle(parser)
+        self._insert_shard(parser)
+        self._insert_sampling(parser)
+        self._insert_stats(parser)
+        self._insert_pipeline(parser)
         parser.add_argument("entries",
                             help="manual entries to test",
                             metavar="text",
@@ -642,6 +1425,7 @@ class Args:
                             action="append",
                             dest="recur_paths",
                             default=[])
+        self._insert_scan_options(parser)
         return parser
 
     def install_manual_test(self, subparser):
@@ -651,6 +1435,13 @@ class Args:
             description="Test manually input rule."
         )
         self._insert_silent_action_log(parser)
+        self._insert_sim_log(parser)
+        self._insert_output(parser)
+        self._insert_progress(parser)
+        self._insert_throttle(parser)
+        self._insert_shard(parser)
+        self._insert_sampling(parser)
+        self._insert_pipeline(parser)
         parser.add_argument("id_rule",
                             help="regular expression to identify filename")
         parser.add_argument("rename_rule",
@@ -664,6 +1455,7 @@ class Args:
                             type=int,
                             default=0,
                             metavar="x")
+        self._insert_folder(parser)
         parser.add_argument("-s", "--scan",
                             help="test on files from given path, not recursive",
                             metavar="path",
@@ -676,6 +1468,7 @@ class Args:
                             action="append",
                             dest="recur_paths",
                             default=[])
+        self._insert_scan_options(parser)
         return parser
 
     def install_rules(self, subparser):
@@ -692,7 +1485,12 @@ class Args:
             dest="action",
             help="Action to do")
         self.install_add_rule(subsubparser)
+        self.install_export_rules(subsubparser)
+        self.install_import_rules(subsubparser)
         self.install_list_rules(subsubparser)
+        self.install_priority_rule(subsubparser)
+        self.install_profile_rules(subsubparser)
+        self.install_release_rule(subsubparser)
         self.install_remove_rule(subsubparser)
         return parser
 
@@ -707,7 +1505,10 @@ class Args:
         parser.add_argument("id_rule",
                             help="regular expression to identify filename")
         parser.add_argument("rename_rule",
-                            help="format rule to rename filename")
+                            help=("format rule to rename filename, with the"
+                                  " groups of the identifier and the fields"
+                                  " {size}, {mtime}, {sha1} and {md5} of the"
+                                  " file (like {sha1:8})"))
         parser.add_argument("name",
                             help="name of the rule (optional)",
                             nargs="?")
@@ -716,8 +1517,60 @@ class Args:
                             type=int,
                             default=0,
                             metavar="x")
+        self._insert_folder(parser)
+        parser.add_argument("--priority",
+                            help="rules with higher priority are tried first",
+                            type=int,
+                            default=0,
+                            metavar="p")
+        parser.add_argument("--suffix",
+                            help=("only try the rule on files with this"
+                                  " suffix, case insensitive (repeatable;"
+                                  " default is found from the end of the"
+                                  " identifier, like '\\.mkv$')"),
+                            dest="suffixes",
+                            action="append",
+                            metavar=".ext")
+        return parser
+
+    def install_export_rules(self, subparser):
+        parser = subparser.add_parser(
+            "export",
+            help="Export rules.",
+            description="Write all rules of the database into a file."
+        )
+        self._add_conf_argument(parser, depth=3)
+        self._add_db_argument(parser, depth=2)
+        parser.add_argument("path",
+                            help="file to write, or '-' for the output")
+        self._insert_rule_file_format(parser)
         return parser
 
+    def install_import_rules(self, subparser):
+        parser = subparser.add_parser(
+            "import",
+            help="Import rules.",
+            description=("Add rules from a file into the database. Rules"
+                         " are all checked first: if one is invalid, none"
+                         " is added. Rules with the id of an existing rule"
+                         " are skipped.")
+        )
+        self._add_conf_argument(parser, depth=3)
+        self._add_db_argument(parser, depth=2)
+        parser.add_argument("path",
+                            help="file to read, or '-' for the input")
+        self._insert_rule_file_format(parser)
+        return parser
+
+    def _insert_rule_file_format(self, parser):
+        return parser.add_argument(
+            "--format",
+            help=("JSON lines or CSV with the fields: "
+                  + ", ".join(well.EXPORT_FIELDS)
+                  + " (default is from the extension of the file, else"
+                  " 'jsonl')"),
+            choices=("jsonl", "csv"))
+
     def install_list_rules(self, subparser):
         parser = subparser.add_parser(
             "list",
@@ -726,6 +1579,63 @@ class Args:
         )
         self._add_conf_argument(parser, depth=3)
         self._add_db_argument(parser, depth=2)
+        parser.add_argument("--adaptive",
+                            help="list in the order of adaptive mode",
+                            action="store_true")
+        return parser
+
+    def install_priority_rule(self, subparser):
+        parser = subparser.add_parser(
+            "priority",
+            help="Change the priority of a rule.",
+            description=("Change the priority of a rule. Rules with higher"
+                         " priority are always tried first.")
+        )
+        self._add_conf_argument(parser, depth=3)
+        self._add_db_argument(parser, depth=2)
+        self._insert_rule_lookup(parser, optional=False)
+        parser.add_argument("priority",
+                            help="new priority (default is 0)",
+                            type=int,
+                            metavar="p")
+        return parser
+
+    def install_profile_rules(self, subparser):
+        parser = subparser.add_parser(
+            "profile",
+            help="Measure the cost of rules.",
+            description=("Time rules over a corpus of paths, and flag"
+                         " patterns whose time grows faster than the"
+                         " length of the path.")
+        )
+        self._add_conf_argument(parser, depth=3)
+        self._add_db_argument(parser, depth=2)
+        self._insert_rule_lookup(parser)
+        parser.add_argument("--corpus",
+                            help=("folder to scan recursively, or file with"
+                                  " one path per line"),
+                            metavar="path",
+                            required=True)
+        parser.add_argument("--limit",
+                            help="maximum number of paths used (default 10000)",
+                            type=int,
+                            default=10000,
+                            metavar="n")
+        parser.add_argument("--quick",
+                            help="skip the adversarial inputs",
+                            action="store_true")
+        return parser
+
+    def install_release_rule(self, subparser):
+        parser = subparser.add_parser(
+            "release",
+            help="Take rules out of quarantine.",
+            description=("Take rules out of quarantine, so they are tried"
+                         " again.")
+        )
+        self._add_conf_argument(parser, depth=3)
+        self._add_db_argument(parser, depth=2)
+        self._insert_rule_lookup(parser, optional=False)
         return parser
 
     def install_remove_rule(self, subparser):
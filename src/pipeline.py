@@ -0,0 +1,120 @@
+"""
+Pipeline to scan, match and rename at the same time.
+
+Stages are linked by bounded queues: a slow stage holds back the others
+instead of piling up entries in memory.
+Blocking calls on the file system are run in threads.
+
+It requires Python >= 3.5.
+"""
+
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import logger
+
+
+# number of entries moved at once between stages
+BATCH_SIZE = 256
+
+# number of batches waiting between two stages
+QUEUE_SIZE = 8
+
+
+def _take(entries, size: int) -> list:
+    return list(itertools.islice(entries, size))
+
+
+def _execute_all(execute: callable, batch: list):
+    for (entry, user_given, candidates) in batch:
+        execute(entry, candidates, user_given)
+
+
+async def _scan(loop, executor, entries, output: asyncio.Queue):
+    """
+    Producer of entries: walking the folders is done in a thread.
+    """
+    while True:
+        batch = await loop.run_in_executor(executor, _take,
+                                           entries, BATCH_SIZE)
+        if not batch:
+            break
+        await output.put(batch)
+    await output.put(None)
+
+
+async def _match(find: callable,
+                 input_: asyncio.Queue,
+                 output: asyncio.Queue):
+    """
+    Find renames to do for each entry.
+    """
+    while True:
+        batch = await input_.get()
+        if batch is None:
+            break
+
+        matched = []
+        for (entry, user_given) in batch:
+            candidates = list(find(entry))
+            if candidates:
+                matched.append((entry, user_given, candidates))
+
+        if matched:
+            await output.put(matched)
+    await output.put(None)
+
+
+async def _rename(loop, executor, execute: callable, input_: asyncio.Queue):
+    """
+    Consumer of renames: renames and log are done in a thread, in order.
+    """
+    while True:
+        batch = await input_.get()
+        if batch is None:
+            break
+        await loop.run_in_executor(executor, _execute_all, execute, batch)
+
+
+async def _run(loop, entries, find: callable, execute: callable):
+    found = asyncio.Queue(maxsize=QUEUE_SIZE)
+    matched = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    # one thread for the scan, one for the renames
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        stages = [
+            asyncio.ensure_future(_scan(loop, executor, entries, found)),
+            asyncio.ensure_future(_match(find, found, matched)),
+            asyncio.ensure_future(_rename(loop, executor, execute, matched))
+        ]
+
+        done, pending = await asyncio.wait(
+            stages, return_when=asyncio.FIRST_EXCEPTION)
+
+        # a failing stage would leave the others waiting forever
+        for stage in pending:
+            stage.cancel()
+        for stage in done:
+            stage.result()
+
+
+def run(entries: iter, find: callable, execute: callable):
+    """
+    Run the pipeline until all entries are done.
+
+    `entries` yields (entry, given by user), `find(entry)` yields the
+    candidates to rename the entry, and `execute(entry, candidates,
+    given by user)` renames it.
+    """
+    logger.info("start pipeline")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run(loop, iter(entries), find, execute))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    logger.info("pipeline done")
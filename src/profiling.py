@@ -0,0 +1,161 @@
+"""
+Measure the cost of rules.
+
+Rules are timed over a corpus of paths, and their identifier is tried
+against inputs of growing length to find patterns whose time does not
+grow linearly (catastrophic backtracking).
+"""
+
+import math
+import time
+import itertools
+
+import book
+
+
+# time above which a single search stops the probe
+PROBE_BUDGET = 0.05
+
+# inputs shorter than this reaching the budget are catastrophic
+CATASTROPHIC_LENGTH = 64
+
+# longest adversarial input tried
+PROBE_MAX_LENGTH = 4096
+
+# minimal time to measure a search, to get above the clock resolution
+PROBE_MIN_TIME = 0.001
+
+# exponent of the growth above which a pattern is flagged
+SUPER_LINEAR = 1.5
+
+# characters always used to build adversarial inputs
+PROBE_CHARS = "a1 ._-/"
+
+# regular expression syntax, not worth building inputs with
+REGEX_SYNTAX = "\\()[]{}*+?|^$"
+
+
+class RuleCost:
+    """
+    Cost of a rule over a corpus and on adversarial inputs.
+    """
+
+    def __init__(self, rule: book.Rule):
+        self.rule = rule
+        self.tries = 0
+        self.hits = 0
+        self.match_time = 0.0
+
+        # growth exponent of the worst adversarial input
+        self.growth = None
+        # length of the input that took more than the budget, if any
+        self.catastrophic_length = None
+
+    @property
+    def ns_per_match(self) -> float:
+        if self.tries:
+            return self.match_time * 1e9 / self.tries
+        return 0.0
+
+    @property
+    def flagged(self) -> bool:
+        return (self.catastrophic_length is not None
+                or (self.growth or 0.0) > SUPER_LINEAR)
+
+    def verdict(self) -> str:
+        if self.catastrophic_length is not None:
+            return "catastrophic (over {:.0f} ms at {} chars)".format(
+                PROBE_BUDGET * 1e3, self.catastrophic_length)
+        elif self.growth is None:
+            return "unknown"
+        elif self.growth > SUPER_LINEAR:
+            return "super-linear (n^{:.1f})".format(self.growth)
+        return "linear (n^{:.1f})".format(self.growth)
+
+
+def time_corpus(cost: RuleCost, corpus: list):
+    """
+    Time the rule over each path of the corpus.
+    """
+    rule = cost.rule
+    for path in corpus:
+        start = time.perf_counter()
+        match = rule.match(path)
+        cost.match_time += time.perf_counter() - start
+        cost.tries += 1
+        cost.hits += bool(match)
+
+
+def _probe_lengths():
+    # small steps first: exponential patterns blow up quickly
+    length = 4
+    while length < 32:
+        yield length
+        length += 1
+    while length <= PROBE_MAX_LENGTH:
+        yield length
+        length = int(length * 1.5)
+
+
+def _time_search(search: callable, text: str) -> float:
+    """
+    Time of one search, repeated to be above the clock resolution.
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        search(text)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= PROBE_MIN_TIME or elapsed >= PROBE_BUDGET:
+            return elapsed / count
+
+
+def _growth(timings: list) -> float:
+    """
+    Exponent k of `time ~ length^k`, from the largest inputs.
+    """
+    (l1, t1), (l2, t2) = timings[len(timings) // 2], timings[-1]
+    if l1 == l2 or t1 <= 0.0 or t2 <= 0.0:
+        return 0.0
+    return math.log(t2 / t1) / math.log(l2 / l1)
+
+
+def probe(cost: RuleCost):
+    """
+    Try the identifier on adversarial inputs of growing length: a repeated
+    character, followed or not by one the pattern cannot expect.
+    """
+    pattern = cost.rule.identifier_as_text
+    search = cost.rule.identifier.search
+
+    chars = set(PROBE_CHARS)
+    chars.update(c for c in pattern
+                 if c.isprintable() and c not in REGEX_SYNTAX)
+
+    cost.growth = 0.0
+    for (char, end) in itertools.product(sorted(chars), ("", "\0")):
+        timings = []
+        for length in _probe_lengths():
+            duration = _time_search(search, char * length + end)
+            if duration >= PROBE_BUDGET and length < CATASTROPHIC_LENGTH:
+                cost.catastrophic_length = length
+                return
+            timings.append((length, duration))
+            if duration >= PROBE_BUDGET:
+                break
+        cost.growth = max(cost.growth, _growth(timings))
+
+
+def profile(rules: iter, corpus: list, adversarial: bool=True) -> [RuleCost]:
+    """
+    Measure the cost of all rules.
+    """
+    costs = []
+    for rule in rules:
+        cost = RuleCost(rule)
+        time_corpus(cost, corpus)
+        if adversarial:
+            probe(cost)
+        costs.append(cost)
+    return costs
@@ -0,0 +1,126 @@
+"""
+Progress of long runs, shown on stderr when it is a terminal.
+
+A single status line is redrawn at most every INTERVAL seconds, like:
+
+    120 folder(s), 53211 file(s) (8120/s), 1203 matched, 1198 renamed,
+    5 failed, ETA 0:01:12
+
+The ETA is only known when the amount of work is, like from a plan.
+When only a sample of the entries is tried, the files (and what follows)
+are counted as "sampled", as they are not the totals of the tree.
+"""
+
+import sys
+import time
+import datetime
+import threading
+
+
+# seconds between two updates of the status line
+INTERVAL = 0.2
+
+# go back to the start of the line, and erase it
+ERASE_LINE = "\r\033[K"
+
+
+class Progress:
+    """
+    Counters of a run, and the status line showing them.
+    """
+
+    def __init__(self, stream=None, enabled: bool=True):
+        self.stream = stream or sys.stderr
+        self.enabled = enabled and self.stream.isatty()
+        self.folders = 0
+        self.files = 0
+        self.matched = 0
+        self.renamed = 0
+        self.failed = 0
+        # the files counted are a sample of the entries scanned
+        self.sampled = False
+        # part of the work done, from 0 to 1, if known
+        self.fraction = None
+        self._start = time.monotonic()
+        self._next = self._start + INTERVAL
+        self._shown = False
+        self._used = False
+        # the scan and the renames may run in different threads
+        self._lock = threading.Lock()
+
+    def folder(self, path: str=None):
+        """
+        Count a folder scanned.
+        """
+        self.folders += 1
+        self.tick()
+
+    def count_files(self, entries: iter) -> iter:
+        """
+        Iterate over the entries, counting them as files.
+        """
+        for entry in entries:
+            self.files += 1
+            self.tick()
+            yield entry
+
+    def result(self, success: bool, simulated: bool):
+        """
+        Count a rename done or failed.
+        """
+        if not success:
+            self.failed += 1
+        elif not simulated:
+            self.renamed += 1
+
+    def tick(self):
+        """
+        Show the status if it is time to.
+        """
+        if self.enabled and time.monotonic() >= self._next:
+            self.show()
+
+    def show(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            self._next = now + INTERVAL
+            elapsed = max(now - self._start, 1e-6)
+            text = ("{} folder(s), {} {}file(s) ({:.0f}/s), {} matched,"
+                    " {} renamed, {} failed").format(
+                        self.folders, self.files,
+                        "sampled " if self.sampled else "",
+                        self.files / elapsed,
+                        self.matched, self.renamed, self.failed)
+            done = self.fraction() if self.fraction else 0
+            if done > 0:
+                eta = elapsed * (1 - done) / done
+                text += ", ETA {}".format(datetime.timedelta(seconds=int(eta)))
+            self.stream.write(ERASE_LINE + text)
+            self.stream.flush()
+            self._shown = True
+            self._used = True
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Erase the status, before writing on the same terminal. It is shown
+        again on the next tick.
+        """
+        if self._shown:
+            self.stream.write(ERASE_LINE)
+            self.stream.flush()
+            self._shown = False
+            self._next = 0
+
+    def close(self):
+        """
+        Leave the last status, if it was shown at all.
+        """
+        if self.enabled and self._used:
+            self.show()
+            self.stream.write("\n")
+            self.stream.flush()
+        self.enabled = False
@@ -0,0 +1,213 @@
+"""
+Report renames to the user or to other programs.
+
+Reports are buffered: lines are formatted and written in batches, instead
+of a `print` for each rename.
+"""
+
+import sys
+import json
+
+import action
+
+
+# number of lines written at once
+BATCH_SIZE = 1024
+
+FORMATS = ("text", "jsonl", "tsv", "quiet", "summary")
+
+
+def status(success: bool, action_mode: action.Flag) -> str:
+    """
+    Short status of an action, like '#rs' or 'Smi', ending with 'd' for a
+    folder.
+    """
+    return "{}{}{}{}".format(
+        "!" if not success else ("S" if action_mode.is_simulated else "#"),
+        "m" if action_mode.rule_is_manual else "r",
+        "s" if action_mode.entry_was_found else "i",
+        "d" if action_mode.is_folder else "")
+
+
+class Report:
+    """
+    Human readable report, as `S:r:s: 'source' --> 'dest'`.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lines = []
+        # on a terminal, renames are shown as they are done
+        self.batch_size = BATCH_SIZE
+        self._tty = self.stream.isatty()
+        if self._tty:
+            self.batch_size = 1
+        # progress status, erased before writing on the same terminal
+        self.progress = None
+
+    def rename(self,
+               success: bool,
+               action_mode: action.Flag,
+               rule_id: str,
+               rule_prefix: str,
+               source: str,
+               dest: str):
+        """
+        Report a rename. The rule prefix is None when not known (from the
+        log).
+        """
+        if rule_prefix is None:
+            self._add("{}: '{}' --> '{}'\n".format(
+                status(success, action_mode), source, dest))
+        else:
+            self._add("{}:{}: '{}' --> '{}'\n".format(
+                status(success, action_mode), rule_prefix, source, dest))
+
+    def summary(self, line: action.SummaryLine):
+        """
+        Report the summary of simulated renames of a run.
+        """
+        self._add("{}: {} simulated rename(s) on {}\n".format(
+            status(True, line.mode), line.total, line.when))
+        for (rule_id, count) in sorted(line.counts.items()):
+            self._add("  {}: {}\n".format(rule_id, count))
+        for (rule_id, source, dest) in line.examples:
+            self._add("  e.g. {}: '{}' --> '{}'\n".format(rule_id, source,
+                                                         dest))
+
+    def _add(self, text: str):
+        self._lines.append(text)
+        if len(self._lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write what is buffered, like before asking something to the user.
+        """
+        if self._lines:
+            if self.progress and self._tty:
+                self.progress.clear()
+            self.stream.write("".join(self._lines))
+            self._lines.clear()
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class JsonReport(Report):
+    """
+    One JSON object per line: renames have the keys status, success,
+    simulated, rule, source and dest; summaries of simulations have the keys
+    status, when, counts and examples.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.batch_size = BATCH_SIZE
+        self._encode = json.JSONEncoder(ensure_ascii=False).encode
+
+    def rename(self, success, action_mode, rule_id, rule_prefix, source,
+               dest):
+        self._add(self._encode({
+            "status": status(success, action_mode),
+            "success": bool(success),
+            "simulated": action_mode.is_simulated,
+            "rule": rule_id,
+            "source": str(source),
+            "dest": str(dest)
+        }) + "\n")
+
+    def summary(self, line):
+        self._add(self._encode({
+            "status": status(True, line.mode),
+            "when": line.when,
+            "counts": line.counts,
+            "examples": line.examples
+        }) + "\n")
+
+
+class TsvReport(Report):
+    """
+    Tab separated columns: status, rule id, source, dest and count (1 for a
+    rename, else the number of simulated renames of a rule in a summary,
+    with empty paths).
+    Tabs, new lines and backslashes in paths are escaped with a backslash.
+    """
+
+    ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n",
+                             "\r": "\\r"})
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.batch_size = BATCH_SIZE
+
+    def rename(self, success, action_mode, rule_id, rule_prefix, source,
+               dest):
+        self._add("\t".join((status(success, action_mode),
+                             str(rule_id),
+                             str(source).translate(self.ESCAPES),
+                             str(dest).translate(self.ESCAPES),
+                             "1\n")))
+
+    def summary(self, line):
+        status_ = status(True, line.mode)
+        for (rule_id, count) in sorted(line.counts.items()):
+            self._add("{}\t{}\t\t\t{}\n".format(status_, rule_id, count))
+
+
+class QuietReport(Report):
+    """
+    Report nothing.
+    """
+
+    def rename(self, *_):
+        pass
+
+    def summary(self, line):
+        pass
+
+
+class SummaryReport(Report):
+    """
+    Only the number of renames by status and by rule, at the end.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.by_status = {}
+        self.by_rule = {}
+
+    def rename(self, success, action_mode, rule_id, rule_prefix, source,
+               dest):
+        self._count(status(success, action_mode), rule_id, 1)
+
+    def summary(self, line):
+        status_ = status(True, line.mode)
+        for (rule_id, count) in line.counts.items():
+            self._count(status_, rule_id, count)
+
+    def _count(self, status_: str, rule_id: str, count: int):
+        self.by_status[status_] = self.by_status.get(status_, 0) + count
+        self.by_rule[rule_id] = self.by_rule.get(rule_id, 0) + count
+
+    def close(self):
+        for (status_, count) in sorted(self.by_status.items()):
+            self._add("{}: {}\n".format(status_, count))
+        for (rule_id, count) in sorted(self.by_rule.items()):
+            self._add("  {}: {}\n".format(rule_id, count))
+        self._add("total: {}\n".format(sum(self.by_status.values())))
+        super().close()
+
+
+def make_report(format_: str, stream=None) -> Report:
+    """
+    Report in one of the FORMATS.
+    """
+    return {
+        "text": Report,
+        "jsonl": JsonReport,
+        "tsv": TsvReport,
+        "quiet": QuietReport,
+        "summary": SummaryReport
+    }[format_ or "text"](stream)
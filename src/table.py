@@ -0,0 +1,206 @@
+"""
+The action log as columns, to count actions by rule, day or status without
+making an object of each one.
+
+    log.open_read()
+    table = LogTable.load(log)
+    for row in table.stats("rule"):
+        print(row.group, row.total, row.failed)
+
+Columns are arrays of numbers: a few bytes per action, and counted by
+`collections.Counter` without a Python loop.
+"""
+
+import array
+import datetime
+import operator
+import collections
+from collections import namedtuple
+from itertools import repeat
+
+import action
+import report
+
+
+GROUP_BY = ("rule", "day", "status")
+
+# status of an action: its mode flags, then its result above them (none
+# while the action is being done)
+RESULT_SHIFT = 4
+MODE_MASK = (1 << RESULT_SHIFT) - 1
+RESULTS = {None: 0, True: 1 << RESULT_SHIFT, False: 2 << RESULT_SHIFT}
+# number of statuses
+STATUSES = 4 << RESULT_SHIFT
+
+# field of the result of an action
+RESULT_FIELD = action.LOG_LINE_PATHS_END
+
+# times are in seconds since this day
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+_DAY = 24 * 60 * 60
+
+# number of actions of a group, by status
+Stats = namedtuple("Stats", ("group", "total", "renamed", "simulated",
+                             "failed", "unknown"))
+
+
+class LogTable:
+    """
+    Actions of the log, by columns.
+    """
+
+    def __init__(self):
+        # one item per action: time (local, in seconds since 1970), its day,
+        # status and code of the rule
+        self.when = array.array("d")
+        self.day = array.array("H")
+        self.status = array.array("B")
+        self.rule = array.array("I")
+        # rule ids by code
+        self.rules = []
+        self._rule_codes = {}
+        # summaries of simulations, as (day, time, status, rule code, count)
+        self.summaries = []
+        # if loaded, the source and dest of each action, one after the other
+        # in `paths`, each one starting at its offset
+        self.paths = None
+        self.path_offsets = array.array("Q")
+        # last minute read, as (text, day, seconds at its start)
+        self._minute = (None, 0, 0)
+
+    @classmethod
+    def load(cls, log: action.Log, paths: bool=False) -> "LogTable":
+        """
+        Table of the actions of an open log, with their paths if asked.
+        """
+        table = cls()
+        add_when = table.when.append
+        add_day = table.day.append
+        add_status = table.status.append
+        add_rule = table.rule.append
+        rule_codes = table._rule_codes
+        parts = []
+
+        for fields in log.read_fields(paths):
+            if len(fields) == 1:
+                table._add_summary(action.SummaryLine(fields[0]))
+                continue
+
+            when = fields[0]
+            # actions of a segment follow each other in time
+            (minute, day, seconds) = table._minute
+            if when[:16] != minute:
+                (minute, day, seconds) = table._minute = table._parse(when)
+            add_day(day)
+            add_when(seconds + float(when[17:]))
+            code = rule_codes.get(fields[1])
+            if code is None:
+                code = table._rule_code(fields[1])
+            add_rule(code)
+            result = (fields[RESULT_FIELD]
+                      if len(fields) > RESULT_FIELD
+                      else None)
+            add_status(fields[2] | RESULTS[result])
+            if paths:
+                parts += (fields[5], fields[6])
+
+        if paths:
+            offset = 0
+            for part in parts:
+                table.path_offsets.append(offset)
+                offset += len(part)
+            table.path_offsets.append(offset)
+            table.paths = "".join(parts)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.status)
+
+    def source(self, index: int) -> str:
+        return self._path(2 * index)
+
+    def dest(self, index: int) -> str:
+        return self._path(2 * index + 1)
+
+    def _path(self, index: int) -> str:
+        return self.paths[self.path_offsets[index]:
+                          self.path_offsets[index + 1]]
+
+    def _rule_code(self, rule_id: str) -> int:
+        code = self._rule_codes[rule_id] = len(self.rules)
+        self.rules.append(rule_id)
+        return code
+
+    @staticmethod
+    def _parse(when: str) -> (str, int, int):
+        """
+        Minute of an ISO time, with its day and its seconds since 1970.
+        """
+        # parsing by hand is several times faster than strptime
+        day = datetime.date(int(when[0:4]), int(when[5:7]),
+                            int(when[8:10])).toordinal() - _EPOCH
+        return (when[:16], day,
+                day * _DAY + int(when[11:13]) * 3600 + int(when[14:16]) * 60)
+
+    def _add_summary(self, line: action.SummaryLine):
+        (_, day, seconds) = self._parse(line.when)
+        status = line.mode | RESULTS[True]
+        for (rule_id, count) in line.counts.items():
+            code = self._rule_codes.get(rule_id)
+            if code is None:
+                code = self._rule_code(rule_id)
+            self.summaries.append((day, seconds + float(line.when[17:]),
+                                   status, code, count))
+
+    def stats(self, group_by: str) -> [Stats]:
+        """
+        Count the actions of each group (one of GROUP_BY), sorted by group.
+        """
+        # a key per action, from its group and its status
+        if group_by == "status":
+            keys = self.status
+        elif group_by == "rule":
+            keys = map(operator.add,
+                       map(operator.mul, self.rule, repeat(STATUSES)),
+                       self.status)
+        elif group_by == "day":
+            keys = map(operator.add,
+                       map(operator.mul, self.day, repeat(STATUSES)),
+                       self.status)
+        else:
+            raise ValueError("cannot group by {}".format(group_by))
+
+        counts = collections.Counter(keys)
+        for (day, _, status, rule, count) in self.summaries:
+            group = {"status": 0, "rule": rule, "day": day}[group_by]
+            counts[group * STATUSES + status] += count
+
+        groups = {}
+        for (key, count) in counts.items():
+            (group, status) = divmod(key, STATUSES)
+            label = self._label(group_by, group, status)
+            # total, renamed, simulated, failed, unknown
+            row = groups.setdefault(label, [0, 0, 0, 0, 0])
+            row[0] += count
+            row[self._column(status)] += count
+
+        return [Stats(label, *row) for (label, row) in sorted(groups.items())]
+
+    def _label(self, group_by: str, group: int, status: int) -> str:
+        if group_by == "rule":
+            return self.rules[group]
+        elif group_by == "day":
+            return datetime.date.fromordinal(group + _EPOCH).isoformat()
+        mode = action.Flag(status & MODE_MASK)
+        return report.status((status & ~MODE_MASK) == RESULTS[True], mode)
+
+    @staticmethod
+    def _column(status: int) -> int:
+        result = status & ~MODE_MASK
+        if result == RESULTS[None]:
+            return 4
+        elif result == RESULTS[False]:
+            return 3
+        elif status & action.Flag.RENAMED:
+            return 1
+        return 2
@@ -1,9 +1,36 @@
 
 import os
+import re
+import errno
+import math
+import zlib
+import time
+import random
+import fnmatch
+import collections
 from pathlib import Path
 
 import logger
 
+try:
+    import fcntl
+except ImportError:
+    # not on Windows: files are not locked there
+    fcntl = None
+
+try:
+    import ctypes
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                           ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+except (ImportError, OSError, AttributeError, TypeError):
+    # not on Linux, or before glibc 2.28: renames check the destination
+    _renameat2 = None
+
+# flags of renameat2
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
 
 def first_map(func: callable, items: iter):
     """
@@ -24,17 +51,459 @@ def first_that(func: callable, items: iter):
             return item
 
 
-def scan_fs(paths: (Path,), max_depth: int=-1, recursive: bool=False) -> str:
+# compatibility with 3.4, only for this module
+if hasattr(os, "scandir"):
+    _scandir = os.scandir
+else:
+    class _DirEntry:
+        def __init__(self, root: str, name: str):
+            self.name = name
+            self.path = os.path.join(root, name)
+
+        def is_dir(self, follow_symlinks: bool=True) -> bool:
+            if not follow_symlinks and self.is_symlink():
+                return False
+            return os.path.isdir(self.path)
+
+        def is_file(self) -> bool:
+            return os.path.isfile(self.path)
+
+        def is_symlink(self) -> bool:
+            return os.path.islink(self.path)
+
+        def stat(self, follow_symlinks: bool=True) -> os.stat_result:
+            return os.stat(self.path, follow_symlinks=follow_symlinks)
+
+        def inode(self) -> int:
+            return self.stat(follow_symlinks=False).st_ino
+
+    def _scandir(root: str):
+        return (_DirEntry(root, name) for name in os.listdir(root))
+
+
+def _list_folder(root: str) -> list:
+    """
+    Entries of a folder, closed before they are used: scans going down a
+    deep tree, or stopped early, keep no folder open.
+    """
+    entries = _scandir(root)
+    try:
+        return list(entries)
+    finally:
+        # only from 3.6
+        close = getattr(entries, "close", None)
+        if close:
+            close()
+
+
+def split_parents(path: str, height: int) -> (str, str):
+    """
+    Split the path at its `height`-th parent, as strings.
+    Same as `(path.parents[height], path.relative_to(path.parents[height]))`
+    with pathlib, except that the root keeps its trailing separator and is
+    empty for the current folder.
+    Return None if the path has not enough parents.
+    """
+    if height < 0:
+        return None
+
+    parts = path.rsplit(os.sep, height + 1)
+    if len(parts) == height + 2:
+        root = parts[0] + os.sep
+        return (root, path[len(root):])
+    elif len(parts) == height + 1 and not path.startswith(os.sep):
+        return ("", path)
+
+
+def name_matcher(patterns: (str,)) -> callable:
+    """
+    Return a function telling if a name matches any of the patterns.
+    Patterns are globs, or regular expressions if prefixed by 're:'.
+    Return None if there is no pattern.
+    """
+    regexes = [(p[3:] if p.startswith("re:") else fnmatch.translate(p))
+               for p in patterns]
+    if not regexes:
+        return None
+    return re.compile("|".join("(?:{})".format(r) for r in regexes)).match
+
+
+class RateLimiter:
+    """
+    Token bucket, to do at most `rate` operations per second, by bursts of
+    at most a tenth of a second of them.
+    With `adaptive`, the rate is lowered while operations get slower than
+    usual, and raised back when they are fast again.
+    """
+
+    # slower than usual is that many times the usual latency
+    SLOW_FACTOR = 2.0
+    # the rate is not lowered below this part of the max rate
+    MIN_RATE_FACTOR = 1 / 16
+    # seconds between two changes of the rate
+    ADJUST_DELAY = 1.0
+
+    def __init__(self, rate: float, adaptive: bool=False):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, rate / 10)
+        self.adaptive = adaptive
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        # moving averages of the latency of an operation, recent and usual
+        self._latency = None
+        self._usual = None
+        self._adjusted = self._last
+
+    def wait(self, cost: float=1):
+        """
+        Wait until `cost` operations can be done.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # tokens in debt are paid back while sleeping
+        self._tokens -= cost
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+    def observe(self, latency: float, cost: float=1):
+        """
+        Adapt the rate to the time `cost` operations took.
+        """
+        if not self.adaptive:
+            return
+        latency /= cost
+        if self._latency is None:
+            self._latency = self._usual = latency
+            return
+        self._latency += (latency - self._latency) / 8
+        # a slowdown only becomes usual if it lasts
+        slow = self._latency > self.SLOW_FACTOR * self._usual
+        self._usual += (latency - self._usual) / (4096 if slow else 256)
+
+        now = time.monotonic()
+        if now - self._adjusted < self.ADJUST_DELAY:
+            return
+        self._adjusted = now
+        if slow:
+            rate = max(self.rate / 2, self.max_rate * self.MIN_RATE_FACTOR)
+            if rate < self.rate:
+                logger.info("slow file system, down to {:.0f} op/s".format(
+                    rate))
+        else:
+            rate = min(self.rate * 1.25, self.max_rate)
+        self.rate = rate
+
+    def run(self, func: callable, *args, cost: float=1):
+        """
+        Call `func(*args)` once operations are allowed, timing it.
+        """
+        self.wait(cost)
+        start = time.monotonic()
+        result = func(*args)
+        self.observe(time.monotonic() - start, cost)
+        return result
+
+
+def scan_fs(paths: (str,),
+            max_depth: int=-1,
+            recursive: bool=False,
+            exclude: callable=None,
+            sort: bool=False,
+            start_after: str=None,
+            take_folder: callable=None,
+            follow_symlinks: bool=True,
+            one_file_system: bool=False,
+            unique_inodes: bool=False,
+            on_folder: callable=None,
+            throttle: RateLimiter=None) -> str:
+    """
+    Yield the path of files found in the given folders, as strings.
+    Folders whose name is accepted by `exclude` are not entered.
+    Folders whose path is accepted by `take_folder` are yielded, with a
+    trailing separator, instead of their files.
+    A folder is entered once, even if seen again through a bind mount or a
+    symbolic link (followed unless `follow_symlinks` is false). With
+    `one_file_system`, folders on another file system than the folder given
+    are not entered. With `unique_inodes`, hard links to a file already
+    yielded are skipped.
+    If given, `on_folder(path)` is called for each folder entered.
+    Listing folders and stat calls are paced by `throttle`, if given.
+    If sorted by name, the scan can start after a path previously yielded,
+    without entering folders before it.
+    """
     if not recursive:
         max_depth = 0
 
-    def scan_folder(root: Path, limit_depth: int) -> str:
+    # (st_dev, st_ino) of folders entered, and of files if unique
+    visited = set()
+    files_seen = set()
+
+    def scan_folder(root: str,
+                    device: int,
+                    limit_depth: int,
+                    after: list) -> str:
         logger.debug("scan in {} (limit depth:{})".format(root, limit_depth))
-        for entry in root.iterdir():
-            if entry.is_dir() and limit_depth != 0:
-                yield from scan_folder(entry, limit_depth-1)
+        if on_folder:
+            on_folder(root)
+        if throttle:
+            entries = throttle.run(_list_folder, root)
+        else:
+            entries = _list_folder(root)
+        if sort:
+            entries = sorted(entries, key=lambda e: e.name)
+
+        for entry in entries:
+            # skip what is before the start, down to its folder
+            sub_after = None
+            if after:
+                if entry.name < after[0]:
+                    continue
+                elif entry.name == after[0]:
+                    if len(after) == 1:
+                        continue
+                    sub_after = after[1:]
+                else:
+                    after = None
+
+            # keep paths the same as pathlib would
+            path = entry.name if root == os.curdir else entry.path
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                if exclude and exclude(entry.name):
+                    continue
+                elif sub_after is None and take_folder and take_folder(path):
+                    yield path + os.sep
+                elif limit_depth != 0:
+                    if throttle:
+                        stat = throttle.run(lambda: entry.stat(
+                            follow_symlinks=follow_symlinks))
+                    else:
+                        stat = entry.stat(follow_symlinks=follow_symlinks)
+                    if one_file_system and stat.st_dev != device:
+                        continue
+                    elif (stat.st_dev, stat.st_ino) in visited:
+                        logger.info("already scanned: {}".format(path))
+                        continue
+                    visited.add((stat.st_dev, stat.st_ino))
+                    yield from scan_folder(path, stat.st_dev, limit_depth-1,
+                                           sub_after)
             elif entry.is_file():
-                yield entry
+                if unique_inodes:
+                    # the inode of an entry is known without a call to stat
+                    if entry.is_symlink():
+                        stat = entry.stat()
+                        inode = (stat.st_dev, stat.st_ino)
+                    else:
+                        inode = (device, entry.inode())
+                    if inode in files_seen:
+                        continue
+                    files_seen.add(inode)
+                yield path
 
     for root in paths:
-        yield from scan_folder(root, max_depth)
+        root = str(root)
+        after = None
+        if start_after:
+            assert sort, "can only start after a path in a sorted scan"
+            relative = (start_after
+                        if root == os.curdir
+                        else start_after[len(root.rstrip(os.sep)) + 1:])
+            after = relative.split(os.sep)
+        stat = os.stat(root)
+        visited.add((stat.st_dev, stat.st_ino))
+        yield from scan_folder(root, stat.st_dev, max_depth, after)
+
+
+def shard_of(path: str, count: int) -> int:
+    """
+    Return the shard (from 0 to count-1) the path belongs to.
+    The hash is stable across runs and machines, unlike `hash()`.
+    """
+    return zlib.crc32(path.encode("utf8", "surrogateescape")) % count
+
+
+def reservoir_sample(items: iter,
+                     size: int,
+                     rng: random.Random=random) -> (list, int):
+    """
+    Sample uniformly `size` items, in the order they come.
+    Return the sample, and the number of items seen.
+    """
+    # keep the index of items, to give them back in order
+    sample = []
+    seen = 0
+    for (seen, item) in enumerate(items, start=1):
+        if len(sample) < size:
+            sample.append((seen, item))
+        else:
+            index = rng.randrange(seen)
+            if index < size:
+                sample[index] = (seen, item)
+    return ([item for (_, item) in sorted(sample, key=lambda s: s[0])], seen)
+
+
+def wilson_interval(hits: int, total: int, z: float=1.96) -> (float, float):
+    """
+    Confidence interval of a rate measured on a sample (95% by default).
+    """
+    if not total:
+        return (0.0, 1.0)
+    rate = hits / total
+    center = rate + z * z / (2 * total)
+    margin = z * math.sqrt(rate * (1 - rate) / total
+                           + z * z / (4 * total * total))
+    scale = 1 + z * z / total
+    return (max(0.0, (center - margin) / scale),
+            min(1.0, (center + margin) / scale))
+
+
+def lock_file(file_, shared: bool=False, wait: bool=False) -> bool:
+    """
+    Lock an open file for this process only, or for readers if `shared`,
+    until it is closed.
+    Return False if another process holds the lock, unless waiting for it.
+    """
+    if fcntl is None:
+        return True
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not wait:
+        operation |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(file_.fileno(), operation)
+    except (BlockingIOError, PermissionError):
+        return False
+    return True
+
+
+def rename_noreplace(source: str,
+                     dest: str,
+                     src_dir_fd: int=None,
+                     dst_dir_fd: int=None):
+    """
+    Rename a file, raising FileExistsError if the destination exists.
+    On Linux, it is checked by the rename itself: no other process can
+    create the destination in between.
+    Paths are relative to the folders `src_dir_fd` and `dst_dir_fd`, if
+    given.
+    """
+    global _renameat2
+    if _renameat2 is not None:
+        if not _renameat2(AT_FDCWD if src_dir_fd is None else src_dir_fd,
+                          os.fsencode(source),
+                          AT_FDCWD if dst_dir_fd is None else dst_dir_fd,
+                          os.fsencode(dest),
+                          RENAME_NOREPLACE):
+            return
+        error = ctypes.get_errno()
+        if error == errno.ENOSYS:
+            # the kernel is too old
+            _renameat2 = None
+        elif error != errno.EINVAL:
+            raise OSError(error, os.strerror(error), source, None, dest)
+        # else the file system does not support it
+
+    try:
+        os.stat(dest, dir_fd=dst_dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        os.rename(source, dest, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+    else:
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                              source, None, dest)
+
+
+class FolderFds:
+    """
+    Open folders, the last used first, to rename files in them by name:
+    the system does not resolve their whole path again for each file.
+    An open folder follows it when moved by another process: it is checked
+    to still be at its path when not checked for VERIFY_AFTER seconds. A
+    folder removed meanwhile is empty: renames in it fail as not found,
+    and callers can try again with the folders opened anew.
+    """
+
+    # a folder opened only to name it, without reading it, if possible
+    FLAGS = getattr(os, "O_PATH", os.O_RDONLY) | getattr(os, "O_DIRECTORY", 0)
+
+    supported = (os.rename in os.supports_dir_fd
+                 and os.mkdir in os.supports_dir_fd)
+
+    VERIFY_AFTER = 1.0
+
+    def __init__(self, size: int=32):
+        self.size = size
+        # (fd, time it was last found at its path) by path
+        self._fds = collections.OrderedDict()
+
+    def open(self, path: str, create: bool=False) -> int:
+        """
+        File descriptor of the folder, created with its parents if asked.
+        """
+        cached = self._fds.get(path)
+        if cached is not None:
+            if self._valid(path, *cached):
+                self._fds.move_to_end(path)
+                return cached[0]
+            os.close(self._fds.pop(path)[0])
+
+        try:
+            fd = os.open(path, self.FLAGS)
+        except FileNotFoundError:
+            if not create:
+                raise
+            (parent, name) = os.path.split(path)
+            try:
+                os.mkdir(name, dir_fd=self.open(parent or os.curdir, True))
+            except FileExistsError:
+                # created meanwhile
+                pass
+            fd = os.open(path, self.FLAGS)
+
+        self._fds[path] = (fd, time.monotonic())
+        if len(self._fds) > self.size:
+            os.close(self._fds.popitem(last=False)[1][0])
+        return fd
+
+    def _valid(self, path: str, fd: int, verified: float) -> bool:
+        """
+        Tell if the open folder is still the one at the path, checking it
+        again if it was not checked for VERIFY_AFTER seconds.
+        """
+        now = time.monotonic()
+        if now - verified < self.VERIFY_AFTER:
+            return True
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(fd)
+        if (current.st_dev, current.st_ino) != (stat.st_dev, stat.st_ino):
+            return False
+        self._fds[path] = (fd, now)
+        return True
+
+    def clear(self):
+        """
+        Close all folders, like after one of them was moved.
+        """
+        for (fd, _) in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+def replace_file(path: Path, write: callable):
+    """
+    Write a file through `write(output)` into a temporary file replacing it
+    at once: readers see either the old or the new file, never half of it.
+    """
+    temp = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+    try:
+        with open(str(temp), "wb") as output:
+            write(output)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(str(temp), str(path))
+    finally:
+        if temp.exists():
+            temp.unlink()
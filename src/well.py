@@ -3,13 +3,29 @@
 Load and Save functionalities.
 
 It drops and pulls from the well.
+
+Rules are saved whole into the database, and rules added one at a time are
+appended to its journal (`<database>.journal`) until the next whole save.
 """
 
 from pathlib import Path
 import pickle
+import json
+import csv
+import re
+import string
 
 import logger
 import book
+from utils import lock_file, replace_file
+
+
+# the journal is folded into the database once larger than both
+COMPACT_MIN_SIZE = 64 * 1024
+
+# fields of rules in exported files
+EXPORT_FIELDS = ("guid", "name", "id", "rn", "height", "folder",
+                 "priority", "suffixes", "quarantined")
 
 
 def serialize_rule(rule: book.Rule) -> dict:
@@ -18,34 +34,85 @@ def serialize_rule(rule: book.Rule) -> dict:
         "id": str(rule.identifier_as_text),
         "rn": str(rule.renamer_as_text),
         "name": str(rule.name) if rule.name else None,
-        "height": int(rule.height)
+        "height": int(rule.height),
+        "folder": bool(rule.folder),
+        "priority": int(rule.priority),
+        "quarantined": bool(rule.quarantined),
+        "suffixes": (sorted(rule.declared_suffixes)
+                     if rule.declared_suffixes is not None
+                     else None),
+        "stats": (int(rule.tries), int(rule.hits), float(rule.match_time))
     }
 
 
 def deserialize_rule(rules: book.Rules, data: dict) -> book.Rule:
-    return rules.add(
+    rule = rules.add(
         id_rule=data["id"],
         rename_rule=data["rn"],
         guid=data["guid"],
         name=data["name"],
-        height=data["height"]
+        height=data["height"],
+        priority=data.get("priority", 0),
+        suffixes=data.get("suffixes", None),
+        folder=data.get("folder", False)
     )
+    if rule:
+        rule.quarantined = data.get("quarantined", False)
+        (rule.tries,
+         rule.hits,
+         rule.match_time) = data.get("stats", (0, 0, 0.0))
+    return rule
+
+
+def journal_path(path: Path) -> Path:
+    return Path(str(path) + ".journal")
 
 
 def save_rules(path: Path, rules: book.Rules):
     """
-    Save rules to file.
+    Save rules to file, emptying the journal.
+    Rules added by other processes since the rules were loaded are kept.
     """
     logger.info("Saving rules to %s", path)
-    with open(str(path), "wb") as output:
-        writer = pickle.Pickler(output, pickle.DEFAULT_PROTOCOL)
-        writer.dump({
-            "version": 1,
-            "rules": tuple(serialize_rule(r) for r in rules)
-        })
+    # the journal is locked by whoever writes rules
+    with open(str(journal_path(path)), "a+b") as journal:
+        lock_file(journal, wait=True)
+        if rules.stored_guids is not None:
+            for rule in _load_locked(path, journal):
+                if (rule.guid not in rules.stored_guids
+                        and rule.guid not in rules.rules):
+                    deserialize_rule(rules, serialize_rule(rule))
+        _write_database(path, rules, journal)
     logger.info("Rules saved.")
 
 
+def append_rule(path: Path, rule: book.Rule):
+    """
+    Save a new rule to file, without rewriting the others.
+    Its guid is created again if a stored rule already has it.
+    """
+    logger.info("Appending rule %s to %s", rule.guid, path)
+    with open(str(journal_path(path)), "a+b") as journal:
+        lock_file(journal, wait=True)
+        # still locked, so that no rule with the same guid is appended
+        stored = _load_locked(path, journal)
+        if rule.guid in stored.rules:
+            rule.guid = stored.new_guid(rule.identifier_as_text,
+                                        rule.renamer_as_text)
+            logger.info("Rule id taken, created %s instead", rule.guid)
+        journal.seek(0, 2)
+        journal.write(pickle.dumps(("add", serialize_rule(rule)),
+                                   pickle.DEFAULT_PROTOCOL))
+        journal.flush()
+
+        # still locked, so that no rule is appended before it is emptied
+        if journal.tell() > max(COMPACT_MIN_SIZE, path.stat().st_size
+                                if path.exists() else 0):
+            logger.info("Compact the journal")
+            deserialize_rule(stored, serialize_rule(rule))
+            _write_database(path, stored, journal)
+
+
 def load_rules(path: Path) -> book.Rules:
     """
     Load rules from file.
@@ -56,13 +123,52 @@ def load_rules(path: Path) -> book.Rules:
 
     if path is None:
         return rules
-    elif not path.exists():
+
+    journal = journal_path(path)
+    if not journal.exists():
+        _load_database(path, rules)
+    else:
+        with open(str(journal), "rb") as input_:
+            # the database is not replaced while its journal is read
+            lock_file(input_, shared=True, wait=True)
+            rules = _load_locked(path, input_)
+    rules.stored_guids = set(rules.rules)
+    return rules
+
+
+def _load_locked(path: Path, journal) -> book.Rules:
+    """
+    Load rules from the database and its open journal, locked by the caller.
+    """
+    rules = book.Rules()
+    _load_database(path, rules)
+    journal.seek(0)
+    _load_journal(journal, rules)
+    return rules
+
+
+def _write_database(path: Path, rules: book.Rules, journal):
+    """
+    Replace the database with the rules, and empty its open journal, locked
+    by the caller.
+    """
+    # other processes may be loading the rules meanwhile
+    replace_file(path, lambda output: pickle.dump({
+        "version": 1,
+        "rules": tuple(serialize_rule(r) for r in rules)
+    }, output, pickle.DEFAULT_PROTOCOL))
+    journal.truncate(0)
+    rules.stored_guids = set(rules.rules)
+
+
+def _load_database(path: Path, rules: book.Rules):
+    if not path.exists():
         logger.info("database path doesn't exists {}".format(path))
-        return rules
+        return
     # special cases for pickle if input is empty
     elif path.stat().st_size <= 0:
         logger.info("empty database")
-        return rules
+        return
 
     with open(str(path), "rb") as input_:
         reader = pickle.Unpickler(input_)
@@ -83,6 +189,105 @@ def load_rules(path: Path) -> book.Rules:
 
         logger.info("Loaded %d rules", len(rules))
 
-    return rules
+
+def _load_journal(input_, rules: book.Rules):
+    count = 0
+    while True:
+        try:
+            (operation, data) = pickle.load(input_)
+        except EOFError:
+            break
+        except pickle.UnpicklingError:
+            # an append cut by a crash
+            logger.warn("journal ends with invalid data")
+            break
+        if operation == "add":
+            deserialize_rule(rules, data)
+        count += 1
+    logger.info("Replayed %d change(s) from the journal", count)
+
+
+def export_rules(output, rules: book.Rules, format_: str):
+    """
+    Write rules into a text file, as JSON lines or CSV.
+    """
+    rows = ({field: serialize_rule(rule)[field] for field in EXPORT_FIELDS}
+            for rule in rules)
+    if format_ == "csv":
+        writer = csv.DictWriter(output, EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            row["suffixes"] = " ".join(row["suffixes"] or ())
+            row["folder"] = int(row["folder"])
+            row["quarantined"] = int(row["quarantined"])
+            writer.writerow(row)
+    else:
+        for row in rows:
+            output.write(json.dumps(row, sort_keys=True) + "\n")
+
+
+def import_rules(input_, rules: book.Rules, format_: str) -> (int, int):
+    """
+    Add rules read from a text file, as JSON lines or CSV.
+    All rules are checked before any is added: on an invalid rule, a
+    ValueError tells its line and nothing is added.
+    Return the number of rules added, and skipped as already existing.
+    """
+    if format_ == "csv":
+        reader = csv.DictReader(input_)
+        rows = ((reader.line_num, row) for row in reader)
+    else:
+        rows = ((number, line)
+                for (number, line) in enumerate(input_, start=1)
+                if line.strip())
+
+    checked = []
+    for (number, row) in rows:
+        try:
+            if format_ != "csv":
+                row = json.loads(row)
+            data = _import_row(row)
+            # compile the identifier and parse the template
+            re.compile(data["id"])
+            tuple(string.Formatter().parse(data["rn"]))
+        except (ValueError, TypeError, re.error) as error:
+            raise ValueError("line {}: {}".format(number, error)) from error
+        checked.append(data)
+
+    added = 0
+    for data in checked:
+        if data["guid"] not in rules.rules:
+            added += bool(deserialize_rule(rules, data))
+    return (added, len(checked) - added)
+
+
+def _import_row(row: dict) -> dict:
+    """
+    Rule data from an imported row, as it is serialized.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("not a rule")
+    for field in ("id", "rn"):
+        if not row.get(field):
+            raise ValueError("missing field '{}'".format(field))
+
+    suffixes = row.get("suffixes") or None
+    if isinstance(suffixes, str):
+        suffixes = suffixes.split()
+    elif suffixes is not None and not isinstance(suffixes, list):
+        raise ValueError("suffixes are not a list")
+    return {
+        "guid": row.get("guid") or None,
+        "id": str(row["id"]),
+        "rn": str(row["rn"]),
+        "name": row.get("name") or None,
+        "height": int(row.get("height") or 0),
+        "folder": _import_flag(row.get("folder")),
+        "priority": int(row.get("priority") or 0),
+        "suffixes": suffixes,
+        "quarantined": _import_flag(row.get("quarantined"))
+    }
 
 
+def _import_flag(value) -> bool:
+    return str(value) in ("1", "True", "true")